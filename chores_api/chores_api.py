@@ -3,49 +3,314 @@
 """chores_api.py
 
 Usage:
-  chores_api.py [<path/to/config_file.yaml>]
+  chores_api.py [--profile-startup] [<path/to/config_file.yaml>]
   chores_api.py (-h | --help)
   chores_api.py --version
   chores_api.py --config-skeleton
+  chores_api.py --compact-history [<path/to/config_file.yaml>]
 
 Options:
   -h --help                 Show this screen.
   --version                 Show version.
   path/to/config_file.yaml  Where preferences are stored [DEFAULT: "~/.config/chores_apirc.yaml"]
   --config-skeleton         Print out contents of a reasonable config file.
+  --profile-startup         Print how long each import and initialization step took before serving.
+  --compact-history         Fold done chores older than each household's keep_weeks into weekly totals, then exit.
 """
 
 version = '1.0.0'
 
-from chores_controller import chores_controller
+import sys
+from chores_lib import chores_lib
+if '--profile-startup' in sys.argv:
+  chores_lib.profile_startup()
+
 import bottle
-import requests
+import datetime
 import json
 from chores_lib.chores_lib import datetime_to_string, \
-    string_to_datetime, string_to_time, config_file_variables
+    string_to_datetime, string_to_time, config_file_variables, \
+    containing_date_range, lazy_module
+# sqlalchemy is by far the slowest import, so wait until the first
+# household's database is opened
+chores_controller = lazy_module('chores_controller.chores_controller')
 import os
+import collections
+import threading
+import traceback
 from docopt import docopt
 
-def main():
-  @bottle.get('/chores')
+##############
+# Households #
+##############
+
+default_rollover_day = 'Friday'
+default_rollover_time = '06:00'
+default_dedupe_window_seconds = 60
+
+# Databases this process has brought up to date, and the lock held
+# while doing so, so the scheduler and requests never migrate one at
+# the same time
+migrated_databases = set()
+migration_lock = threading.Lock()
+
+def migrate_database(settings):
+  """Migrate the database of a household with `settings` (see
+  chores_controller.migrate()) unless this process already has
+  """
+  path = settings['path_to_database']
+  with migration_lock:
+    if path not in migrated_databases:
+      chores_controller.chores_controller(path).close()
+      migrated_databases.add(path)
+
+class household_pool():
+  """Controllers for many households, each with its own database
+
+  `households` maps a household name to its settings
+
+    {'path_to_database': ..., 'rollover_day': ..., 'rollover_time': ..., 'dedupe_window_seconds': ...}
+
+  Controllers are opened lazily on first use and at most
+  `max_open` are kept open, closing the least recently used.
+  """
+  def __init__(self, households, default=None, max_open=8):
+    self.households = households
+    self.default = default
+    self.max_open = max_open
+    self.open_controllers = collections.OrderedDict()
+    # Households whose open controller should reread its catalog
+    # before it's next used
+    self.stale_catalogs = set()
+    self.stale_catalogs_lock = threading.Lock()
+
+  def settings(self, name):
+    """Return settings of household `name` with defaults filled in"""
+    settings = {
+      'rollover_day': default_rollover_day,
+      'rollover_time': default_rollover_time,
+      'dedupe_window_seconds': default_dedupe_window_seconds,
+    }
+    settings.update(self.households[name])
+    return settings
+
+  def controller(self, name):
+    """Return the (possibly newly opened) controller for `name`"""
+    if name in self.open_controllers:
+      controller = self.open_controllers.pop(name)
+      with self.stale_catalogs_lock:
+        stale = name in self.stale_catalogs
+        self.stale_catalogs.discard(name)
+      if stale:
+        controller.reload_catalog()
+    else:
+      settings = self.settings(name)
+      migrate_database(settings)
+      controller = chores_controller.chores_controller(
+          settings['path_to_database'],
+          dedupe_window_seconds=settings['dedupe_window_seconds'],
+          migrate=False)
+      while len(self.open_controllers) >= self.max_open:
+        _, evicted = self.open_controllers.popitem(last=False)
+        evicted.close()
+    self.open_controllers[name] = controller
+    return controller
+
+  def reload_catalogs(self):
+    """Have every open controller reread its catalog when next used
+
+    Safe to call from other threads, since the controllers themselves
+    are only touched by the thread using the pool.
+    """
+    with self.stale_catalogs_lock:
+      self.stale_catalogs.update(self.open_controllers)
+
+def household_dispatcher(app, pool):
+  """WSGI middleware choosing the household for each request
+
+  The household is taken from a `/households/<name>` URL prefix
+  (which is stripped before `app` sees the path), then from an
+  `X-Chores-Household` header, then from `pool.default`.  Requests
+  for unknown households get a 404.
+  """
+  def dispatch(environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    name = None
+    if path.startswith('/households/'):
+      name, _, rest = path[len('/households/'):].partition('/')
+      environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + \
+          '/households/' + name
+      environ['PATH_INFO'] = '/' + rest
+    elif environ.get('HTTP_X_CHORES_HOUSEHOLD'):
+      name = environ['HTTP_X_CHORES_HOUSEHOLD']
+    else:
+      name = pool.default
+    if name not in pool.households:
+      start_response('404 Not Found', [('Content-Type', 'text/plain')])
+      return [b'Unknown household']
+    environ['chores.household'] = name
+    return app(environ, start_response)
+  return dispatch
+
+def households_from_config(conf_vars):
+  """Return a household_pool described by `conf_vars`
+
+  A config without a `households` section serves its single
+  `path_to_database` as the household named 'default'.
+  """
+  defaults = dict((key, conf_vars[key])
+      for key in ('rollover_day', 'rollover_time', 'keep_weeks', 'archive_dir',
+          'dedupe_window_seconds')
+      if key in conf_vars)
+  if conf_vars.get('households'):
+    households = {}
+    for name, settings in conf_vars['households'].items():
+      households[name] = dict(defaults, **settings)
+    default = conf_vars.get('default_household')
+  else:
+    households = {'default': dict(defaults,
+        path_to_database=conf_vars['path_to_database'])}
+    default = 'default'
+  return household_pool(households, default=default,
+      max_open=conf_vars.get('max_open_households', 8))
+
+def compact_household(pool, name, now, keep_weeks=None):
+  """Compact the history of household `name` per chores_controller.compact_history()
+
+  Done chores from before the week `keep_weeks` (default: the
+  household's `keep_weeks` setting) weeks before `now` are folded
+  into weekly totals, and appended to `<archive_dir>/<name>-done_chores.jsonl.gz`
+  first if the household has an `archive_dir`.  Returns None if
+  there's no `keep_weeks` to go by.
+  """
+  settings = pool.settings(name)
+  if keep_weeks is None:
+    keep_weeks = settings.get('keep_weeks')
+  if keep_weeks is None:
+    return None
+  export_path = None
+  if settings.get('archive_dir'):
+    if not os.path.exists(settings['archive_dir']):
+      os.makedirs(settings['archive_dir'])
+    export_path = os.path.join(settings['archive_dir'],
+        '{0}-done_chores.jsonl.gz'.format(name))
+  return pool.controller(name).compact_history(
+      now - datetime.timedelta(weeks=int(keep_weeks)),
+      settings['rollover_day'], string_to_time(settings['rollover_time']),
+      export_path=export_path)
+
+def next_rollover(settings, now):
+  """Return the first rollover of household `settings` after `now`"""
+  return containing_date_range(now, settings['rollover_day'],
+      string_to_time(settings['rollover_time']))['end']
+
+class rollover_scheduler(threading.Thread):
+  """Background thread that, at each household's weekly rollover,
+  records the final standings of the week that just ended (and of
+  any weeks missed while the API wasn't running), then compacts the
+  household's history if it has `keep_weeks`.
+
+  It uses its own database connections, separate from the ones
+  serving requests, and afterwards has `serving_pool` reread its
+  catalogs, picking up chores and users edited behind the API's back.
+  """
+  def __init__(self, households, serving_pool=None):
+    threading.Thread.__init__(self, name='rollover_scheduler')
+    self.daemon = True
+    self.pool = household_pool(households, max_open=1)
+    self.serving_pool = serving_pool
+    self.stopped = threading.Event()
+
+  def run_once(self, now):
+    """Record standings and compact history of every household"""
+    for name in sorted(self.pool.households):
+      try:
+        settings = self.pool.settings(name)
+        controller = self.pool.controller(name)
+        # Score with any chores or users edited behind the API's back
+        controller.reload_catalog()
+        controller.record_weekly_standings(now,
+            settings['rollover_day'], string_to_time(settings['rollover_time']))
+        compact_household(self.pool, name, now)
+      except Exception:
+        # Keep going for the other households and try again next time
+        traceback.print_exc()
+    if self.serving_pool is not None:
+      self.serving_pool.reload_catalogs()
+
+  def run(self):
+    while not self.stopped.is_set():
+      self.run_once(datetime.datetime.now())
+      now = datetime.datetime.now()
+      wake_up = min(next_rollover(self.pool.settings(name), now)
+          for name in self.pool.households)
+      # A second late, so the week has definitely rolled over
+      self.stopped.wait((wake_up - now).total_seconds() + 1)
+
+  def stop(self):
+    self.stopped.set()
+
+#######
+# API #
+#######
+
+def chores_app(pool):
+  """Return a WSGI app serving the API for the households in `pool`"""
+  app = bottle.Bottle()
+
+  def controller():
+    return pool.controller(bottle.request.environ['chores.household'])
+
+  @app.get('/settings')
+  def get_settings():
+    settings = pool.settings(bottle.request.environ['chores.household'])
+    return {'settings': {
+      'household': bottle.request.environ['chores.household'],
+      'rollover_day': settings['rollover_day'],
+      'rollover_time': settings['rollover_time'],
+    }}
+
+  # How often SQLAlchemy found a statement's SQL already compiled.
+  # sqlite3's own prepared statement cache doesn't report its hits.
+  @app.get('/stats')
+  def get_stats():
+    return {'stats': {
+      'statement_cache': controller().statement_cache.stats(),
+    }}
+
+  @app.get('/chores')
   def get_chores():
     # Because of CSRF, you shouldn't return a list of objects.
-    return {'chores': controller.chores()}
+    return {'chores': controller().chores()}
   
-  @bottle.delete('/chores/<chore_id>')
+  @app.delete('/chores/<chore_id>')
   def delete_chore(chore_id):
-    controller.delete_done_chore(chore_id)
+    controller().delete_done_chore(chore_id)
   
-  @bottle.get('/users')
+  # Just the names of users and chores, from memory
+  @app.get('/names')
+  def get_names():
+    catalog = controller().catalog
+    return {'names': {
+      'users': [{'rowid': rowid, 'name': name}
+          for rowid, name in sorted(catalog.users.items())],
+      'chores': [{'rowid': rowid, 'name': chore.name}
+          for rowid, chore in sorted(catalog.chores.items())],
+    }}
+
+  @app.get('/users')
   def get_users():
     # Because of CSRF, you shouldn't return a list of objects.
-    return {'users': controller.users()}
+    return {'users': controller().users()}
   
-  @bottle.put('/chores/<name>/<worth>')
+  @app.put('/chores/<name>/<worth>')
   def new_chore(name, worth):
-    controller.new_chore(name, worth)
+    try:
+      controller().new_chore(name, worth)
+    except ValueError:
+      bottle.abort(400, 'worth must be a whole number')
   
-  @bottle.route('/chores/<chore_id>', method='PATCH')
+  @app.route('/chores/<chore_id>', method='PATCH')
   def change_chore(chore_id):
     received_values = json.loads(bottle.request.body.read())
     things_to_update = {}
@@ -54,58 +319,155 @@ def main():
     if 'name' in received_values:
       things_to_update['name'] = received_values['name']
     if things_to_update != {}:
-      controller.change_chore(chore_id, **things_to_update)
+      try:
+        controller().change_chore(chore_id, **things_to_update)
+      except ValueError:
+        bottle.abort(400, 'worth must be a whole number')
   
   # `user_id` should be an integer
   # `chore_id` should be an integer
   # `done_datetime` should be formatted per datetime_to_string()
-  @bottle.put('/done_chores/<user_id>/<chore_id>/<done_datetime>')
+  # An Idempotency-Key header (or idempotency_key= query) makes
+  # repeating the request safe.  Without one, the same user doing the
+  # same chore twice within dedupe_window_seconds counts once.
+  @app.put('/done_chores/<user_id>/<chore_id>/<done_datetime>')
   def new_done_chore(user_id, chore_id, done_datetime):
-    controller.new_done_chore(user_id, chore_id,
-        string_to_datetime(done_datetime))
+    catalog = controller().catalog
+    try:
+      known = int(user_id) in catalog.users and int(chore_id) in catalog.chores
+    except ValueError:
+      known = False
+    if not known:
+      bottle.abort(404, 'No such user or chore')
+    idempotency_key = bottle.request.headers.get('Idempotency-Key') or \
+        bottle.request.query.get('idempotency_key')
+    recorded = controller().new_done_chore(user_id, chore_id,
+        string_to_datetime(done_datetime), idempotency_key=idempotency_key)
+    return {'recorded': recorded}
   
   # `user_id` should be an integer
   # `now_datetime` should be formatted per datetime_to_string()
   # `rollover_day` should be a day fullname like 'Friday'
   # `rollover_time` should be a 0-padded 24-hour time like '22:01'
-  @bottle.get('/weekly_score/<user_id>/<now_datetime>/<rollover_day>/<rollover_time>')
+  @app.get('/weekly_score/<user_id>/<now_datetime>/<rollover_day>/<rollover_time>')
   def weekly_score(user_id, now_datetime, rollover_day, rollover_time):
-    return {'weekly_score': controller.weekly_score(user_id=user_id, now=string_to_datetime(now_datetime), rollover_day=rollover_day, rollover_time=string_to_time(rollover_time))}
+    return {'weekly_score': controller().weekly_score(user_id=user_id, now=string_to_datetime(now_datetime), rollover_day=rollover_day, rollover_time=string_to_time(rollover_time))}
   
   # `now_datetime` should be formatted per datetime_to_string()
   # `rollover_day` should be a day fullname like 'Friday'
   # `rollover_time` should be a 0-padded 24-hour time like '22:01'
-  @bottle.get('/winner/<now_datetime>/<rollover_day>/<rollover_time>')
+  @app.get('/winner/<now_datetime>/<rollover_day>/<rollover_time>')
   def winner(now_datetime, rollover_day, rollover_time):
-    return {'winner': controller.winner(now=string_to_datetime(now_datetime), rollover_day=rollover_day, rollover_time=string_to_time(rollover_time))}
+    return {'winner': controller().winner(now=string_to_datetime(now_datetime), rollover_day=rollover_day, rollover_time=string_to_time(rollover_time))}
+  
+  # `now_datetime` should be formatted per datetime_to_string()
+  # `rollover_day` should be a day fullname like 'Friday'
+  # `rollover_time` should be a 0-padded 24-hour time like '22:01'
+  @app.get('/weekly_scores/<now_datetime>/<rollover_day>/<rollover_time>')
+  def weekly_scores(now_datetime, rollover_day, rollover_time):
+    return {'weekly_scores': controller().weekly_scores(now=string_to_datetime(now_datetime), rollover_day=rollover_day, rollover_time=string_to_time(rollover_time))}
   
-  @bottle.get('/done_chores/<user_id>')
-  def done_chores(user_id):
+  # Winners of finished weeks, most recent first.  `limit` caps
+  # how many weeks are returned.
+  @app.get('/winners')
+  def winners():
+    limit = bottle.request.query.get('limit')
+    return {'winners': [
+      dict(winner,
+          week_begin=datetime_to_string(winner['week_begin']),
+          week_end=datetime_to_string(winner['week_end']))
+      for winner in controller().weekly_winners(limit=int(limit) if limit else None)
+    ]}
+  
+  # Latest changes to chores, users and done chores after change
+  # `since` (default 0, everything), and the latest change's number to
+  # ask for changes since next time.  See chores_lib.mirror.
+  @app.get('/changes')
+  def changes():
+    return {'changes': controller().changes(
+        since=bottle.request.query.get('since') or 0)}
+  
+  @app.get('/done_chores')
+  @app.get('/done_chores/<user_id>')
+  def done_chores(user_id=None):
     reverse = bottle.request.query.get('reverse')
-    to_return = []
-    if reverse and reverse.lower() == 'true':
-      to_return = {'done_chores': controller.done_chores(user_id=user_id, reverse=True)}
-    else:
-      to_return =  {'done_chores': controller.done_chores(user_id=user_id, reverse=False)}
+    reverse = bool(reverse and reverse.lower() == 'true')
+    # Optionally only those from `begin` up to (not including) `end`
+    try:
+      begin, end = [
+        string_to_datetime(bottle.request.query[bound])
+        if bottle.request.query.get(bound) else None
+        for bound in ('begin', 'end')
+      ]
+    except ValueError:
+      bottle.abort(400, 'begin and end must be datetimes')
   
     # Convert datetime objects so they can be sent as JSON
-    for done_chore in to_return['done_chores']:
-      done_chore['datetime'] = datetime_to_string(done_chore['datetime'])
+    return {'done_chores': [
+      {
+        'rowid': done_chore.rowid,
+        'datetime': datetime_to_string(done_chore.datetime),
+        'chore_id': done_chore.chore_id,
+        'user_id': done_chore.user_id,
+      }
+      for done_chore in controller().iter_done_chores(user_id=user_id,
+          reverse=reverse, begin=begin, end=end)
+    ]}
   
-    return to_return
+  # Done chores from before the week `keep_weeks` weeks ago (default:
+  # the household's keep_weeks setting) are folded into weekly totals
+  @app.post('/compact_history')
+  def compact_history():
+    keep_weeks = bottle.request.query.get('keep_weeks')
+    compacted = compact_household(pool,
+        bottle.request.environ['chores.household'], datetime.datetime.now(),
+        keep_weeks=keep_weeks)
+    if compacted is None:
+      bottle.abort(400, 'No keep_weeks given or configured')
+    compacted['cutoff'] = datetime_to_string(compacted['cutoff'])
+    return {'compacted': compacted}
   
-  @bottle.get('/chore_name/<chore_id>')
+  @app.get('/chore_name/<chore_id>')
   def chore_name(chore_id):
-    return {'name': controller.chore_name(chore_id)}
+    return {'name': controller().chore_name(chore_id)}
 
-  arguments = docopt(__doc__, version=version)
+  return household_dispatcher(app, pool)
+
+def main():
+  with chores_lib.timed('parse arguments'):
+    arguments = docopt(__doc__, version=version)
 
   default_config_skeleton = """path_to_database: {0}
 host_name: localhost
 port: 8190
 debug_mode: ''
-path_to_database: {0}""".format(
-    os.path.join(os.path.abspath('.'), 'default_chores.sql'))
+rollover_day: Friday
+rollover_time: '06:00'
+# The same user doing the same chore more than once in this many
+# seconds (double taps, retries) only counts once.  0 turns this off.
+dedupe_window_seconds: 60
+# Uncomment to keep only this many weeks of individual done chores,
+# folding older ones into weekly totals at each weekly rollover (and
+# whenever --compact-history is run).
+# With archive_dir set, the folded done chores are saved there too.
+# keep_weeks: 52
+# archive_dir: {1}
+# To host several households from this one process, list them
+# here.  Each gets its own database and may override the rollover
+# settings.  Clients select one with a /households/<name> URL prefix
+# or an X-Chores-Household header.
+# households:
+#   smiths:
+#     path_to_database: /path/to/smiths.sql
+#   joneses:
+#     path_to_database: /path/to/joneses.sql
+#     rollover_day: Sunday
+#     rollover_time: '20:00'
+#     keep_weeks: 26
+# default_household: smiths
+# max_open_households: 8""".format(
+    os.path.join(os.path.abspath('.'), 'default_chores.sql'),
+    os.path.join(os.path.abspath('.'), 'archive'))
 
   if arguments['--config-skeleton']:
     print default_config_skeleton
@@ -122,15 +484,33 @@ path_to_database: {0}""".format(
 
   # Fetch variables from config file (or create one if none
   # exists yet)
-  conf_vars = config_file_variables(config_filename,
-      default_config_skeleton)
+  with chores_lib.timed('read config'):
+    conf_vars = config_file_variables(config_filename,
+        default_config_skeleton)
+
+  # Databases are connected to lazily, as households are used
+  with chores_lib.timed('build app'):
+    pool = households_from_config(conf_vars)
+    app = chores_app(pool)
+
+  if arguments['--compact-history']:
+    for name in sorted(pool.households):
+      compacted = compact_household(pool, name, datetime.datetime.now())
+      if compacted is not None:
+        print "{0}: {1} done chores before {2} folded into {3} weekly totals".format(
+            name, compacted['archived'], compacted['cutoff'], compacted['rollups'])
+    exit(0)
+
+  # Record weekly winners as weeks roll over.  Its first run, in its
+  # own thread, is also what opens (and migrates) the databases first.
+  with chores_lib.timed('start rollover scheduler'):
+    rollover_scheduler(pool.households, serving_pool=pool).start()
 
-  # Connect to the database
-  controller = chores_controller.chores_controller(
-      conf_vars['path_to_database'])
+  if arguments['--profile-startup']:
+    print chores_lib.startup_report()
 
   # Actually serve the pages
-  bottle.run(host=conf_vars['host_name'],
+  bottle.run(app=app, host=conf_vars['host_name'],
       port=conf_vars['port'], debug=conf_vars['debug_mode'])
 
 if __name__ == '__main__':
@@ -1,14 +1,152 @@
+import collections
+import contextlib
+import datetime
+import gzip
+import hashlib
+import json
+import threading
 import sqlalchemy
 from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, \
     desc, asc, text, ForeignKey
 from sqlalchemy.sql import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
 from chores_lib import chores_lib
 
 class chores_controller():
-  def __init__(self, path_to_database):
-    self.session = chores_db_session(path_to_database)
+  def __init__(self, path_to_database, dedupe_window_seconds=60,
+      recent_keys_size=1024, migrate=True):
+    self.statement_cache = statement_cache()
+    self.session = chores_db_session(path_to_database, self.statement_cache)
+    self.dedupe_window_seconds = dedupe_window_seconds
+    # Idempotency keys of recently recorded done chores, oldest first,
+    # so repeats are turned away without asking the database
+    self.recent_keys = collections.OrderedDict()
+    self.recent_keys_size = recent_keys_size
+    # Held while replacing self.catalog so concurrent changes aren't lost
+    self.catalog_lock = threading.Lock()
+    self.reload_catalog()
+    if migrate:
+      self.migrate()
+
+  def migrate(self):
+    """Add the tables, columns and indexes this version needs
+
+    Safe to repeat, but not to run from two connections at once, so
+    anything opening several controllers on one database should
+    migrate it once first and open them with migrate=False.
+    """
+    self._add_idempotency_keys()
+    new_change_log = not self.session.bind.has_table('changes')
+    Base.metadata.create_all(self.session.bind,
+        tables=[done_chore_rollups_table, weekly_winners_table, changes_table])
+    if new_change_log:
+      self._log_existing_rows()
+
+  def reload_catalog(self):
+    """Read the chores and users tables into self.catalog
+
+    Only needed if something other than this controller changed
+    them.
+    """
+    with self.catalog_lock:
+      self.catalog = catalog(
+        (chore_record._make(row) for row in
+            self.session.execute(all_chores_statement)),
+        (tuple(row) for row in self.session.execute(all_users_statement)),
+      )
+
+  def _add_idempotency_keys(self):
+    """Give done_chores a uniquely indexed idempotency_key column if
+    it doesn't have one yet
+    """
+    columns = [row[1] for row in self.session.execute(done_chores_columns_statement)]
+    if 'idempotency_key' not in columns:
+      self.session.execute(add_idempotency_key_statement)
+    self.session.execute(idempotency_key_index_statement)
+    self.session.commit()
+
+  @contextlib.contextmanager
+  def _transaction(self):
+    """Roll back whatever was written if the block raises, so a failed
+    write neither keeps the database locked nor gets committed by the
+    next one
+    """
+    try:
+      yield
+    except:
+      self.session.rollback()
+      raise
+
+  def _remember_key(self, idempotency_key):
+    if idempotency_key is not None:
+      self.recent_keys.pop(idempotency_key, None)
+      self.recent_keys[idempotency_key] = True
+      while len(self.recent_keys) > self.recent_keys_size:
+        self.recent_keys.popitem(last=False)
+
+  def _log_changes(self, table_name, op, rows):
+    """Add `rows` (dicts with a 'rowid') of `table_name` to the change
+    log as `op` ('put' or 'delete'), in the current transaction
+    """
+    if rows:
+      self.session.execute(insert_change_statement, [
+        {
+          'table_name': table_name, 'row_id': row['rowid'], 'op': op,
+          'data': json.dumps(row) if op == 'put' else None,
+        }
+        for row in rows
+      ])
+
+  def _log_existing_rows(self):
+    """Start a new change log with every row already there, so
+    changes(since=0) is a complete copy
+    """
+    self._log_changes('chores', 'put',
+        [chore._asdict() for chore in self.catalog.chores_by_worth])
+    self._log_changes('users', 'put', [
+      {'rowid': rowid, 'name': name}
+      for rowid, name in sorted(self.catalog.users.items())
+    ])
+    self._log_changes('done_chores', 'put',
+        [loggable_done_chore(x) for x in self.iter_done_chores()])
+    self.session.commit()
+
+  def changes(self, since=0):
+    """Return changes to chores, users and done chores made after
+    change `since`
+
+      {'version': latest change, 'changes': [{'seq': seq, 'table': table name, 'rowid': rowid, 'op': 'put' or 'delete', 'row': row or None}, ...]}
+
+    Only the latest change to each row is returned, oldest first.  A
+    'put' row is the whole row, with datetimes formatted per
+    chores_lib.datetime_to_string().
+    """
+    version = self.session.execute(latest_change_statement).scalar()
+    return {
+      'version': version,
+      'changes': [
+        {'seq': seq, 'table': table_name, 'rowid': row_id, 'op': op,
+            'row': json.loads(data) if data is not None else None}
+        for seq, table_name, row_id, op, data in self.session.execute(
+            changes_statement, {'since': int(since)})
+      ],
+    }
+
+  def close(self):
+    """Release the session and the engine's connections"""
+    engine = self.session.bind
+    self.session.close()
+    engine.dispose()
+
+  def iter_chores(self):
+    """
+    Iterator over a chore_record for each chore ordered by worth
+    (highest to lowest) from the catalog
+    """
+    return iter(self.catalog.chores_by_worth)
 
   def chores(self):
     """
@@ -18,79 +156,178 @@ class chores_controller():
 
     ordered by worth (highest to lowest) from `session`
     """
-    return [
-      {'rowid': x.rowid, 'name': x.name, 'worth': x.worth}
-      for x in self.session.query(Chore).order_by(desc(Chore.worth)).all()
-    ]
+    return [dict(zip(chore_record._fields, x)) for x in self.iter_chores()]
+
+  def iter_done_chores(self, user_id=None, reverse=False, begin=None, end=None):
+    """
+    Generator yielding a done_chore_record for each done chore,
+    read from `session` as it is iterated rather than all at once,
+    ordered by datetime (choronological if (not `reverse`) else anti-chronological)
 
-  def done_chores(self, user_id=None, reverse=False):
+    Only those from `begin` up to (not including) `end` if they're
+    given.
+    """
+    query = done_chores_statements[
+        (bool(user_id), begin is not None or end is not None, bool(reverse))]
+    for row in self.session.execute(query, {'user_id': user_id,
+        'begin': begin or datetime.datetime.min,
+        'end': end or datetime.datetime.max}):
+      yield done_chore_record._make(row)
+
+  def done_chores(self, user_id=None, reverse=False, begin=None, end=None):
     """
     Return list of done chores from `session`
       [{'rowid': rowid, 'chore_id': chore_id, 'user_id': user_id, 'datetime': datetime}, ...
     ordered by datetime (choronological if (not `reverse`) else anti-chronological)
     """
-    results = self.session.query(Done_chore)
-    if user_id:
-      results = results.filter_by(user_id=user_id)
-    if reverse:
-      results = results.order_by(desc(Done_chore.datetime))
-    else:
-      results = results.order_by(asc(Done_chore.datetime))
     return [
-      {'rowid': row.rowid, 'datetime': row.datetime, 'chore_id': row.chore_id, 'user_id': row.user_id}
-      for row in results.all()
+      dict(zip(done_chore_record._fields, x))
+      for x in self.iter_done_chores(user_id=user_id, reverse=reverse,
+          begin=begin, end=end)
     ]
 
   def chore_name(self, rowid):
-    """Return name corresponding to `rowid` from `session`"""
-    results = self.session.query(Chore.name).filter_by(rowid=rowid)
-    return results.one()[0]
+    """Return name corresponding to `rowid` from the catalog"""
+    return self.catalog.chores[int(rowid)].name
+
+  def points(self, begin=None, end=None):
+    """Return {user_id: points} scored from `begin` up to (not
+    including) `end`, or ever if they're None
+
+    Only the number of each chore done by each user comes from the
+    database.  Worths come from the catalog.
+    """
+    if begin is None:
+      results = self.session.execute(all_chore_counts_statement)
+    else:
+      results = self.session.execute(chore_counts_statement,
+          {'begin': begin, 'end': end})
+    chores = self.catalog.chores
+    points = collections.defaultdict(int)
+    for user_id, chore_id, count in results:
+      chore = chores.get(int(chore_id))
+      if chore is not None:
+        points[int(user_id)] += chore.worth * count
+    return points
 
   def weekly_score(self, user_id, now, rollover_day, rollover_time):
     """Return the total score from the current week for `user_id`"""
 
     date_range = chores_lib.containing_date_range(now, rollover_day, rollover_time)
+    return self.points(date_range['begin'], date_range['end']).get(int(user_id), 0)
 
-    query_string = """
-      SELECT sum(chores.worth)
-      FROM
-        done_chores, chores
-      WHERE
-        done_chores.user_id = {0}
-      AND
-        done_chores.chore_id = chores.rowid
-      AND
-        done_chores.datetime >= "{1}"
-      AND
-        done_chores.datetime < "{2}"
-      ;
-    """.format(user_id, date_range['begin'], date_range['end'])
-
-    results = self.session.query("sum(chores.worth)").from_statement(text(query_string));
-    if results.all()[0][0] is None:
-      return 0
-    else:
-      return results.all()[0][0]
+  def weekly_scores(self, now, rollover_day, rollover_time):
+    """Return the current week's score for every user
 
-  def winner(self, now, rollover_day, rollover_time):
-    scores = [
-      {
-        'user_id': user['rowid'],
-        'week_score': self.weekly_score(user['rowid'], now, rollover_day, rollover_time)
-      }
-      for user in self.users()
+      [{'rowid': rowid, 'name': name, 'week_score': score}, ...]
+
+    ordered by rowid, computed in a single query
+    """
+    date_range = chores_lib.containing_date_range(now, rollover_day, rollover_time)
+    return self.scores_between(date_range['begin'], date_range['end'])
+
+  def scores_between(self, begin, end):
+    """Return every user's score from `begin` up to (not including) `end`
+
+      [{'rowid': rowid, 'name': name, 'week_score': score}, ...]
+
+    ordered by rowid
+    """
+    points = self.points(begin, end)
+    return [
+      {'rowid': rowid, 'name': name, 'week_score': points.get(rowid, 0)}
+      for rowid, name in sorted(self.catalog.users.items())
     ]
 
-    # Find maximum scoring user_id
+  def winner(self, now, rollover_day, rollover_time):
+    """Return {'name': name, 'score': score} of the week's top scorer
+
+    Finished weeks recorded by record_weekly_standings() are read
+    from weekly_winners, anything else is computed from done chores.
+    """
+    date_range = chores_lib.containing_date_range(now, rollover_day, rollover_time)
+    recorded = self.session.execute(recorded_winner_statement,
+        {'week_begin': date_range['begin']}).first()
+    if recorded is not None:
+      return {'name': recorded.name, 'score': recorded.score}
+
+    scores = self.scores_between(date_range['begin'], date_range['end'])
+
+    # Find maximum scoring user
     win = scores[0]
     for score in scores:
       if score['week_score'] > win['week_score']:
         win = score
 
     return {
-        'name': self.user_name(win['user_id']), 'score': win['week_score']
+        'name': win['name'], 'score': win['week_score']
     }
 
+  def record_weekly_standings(self, now, rollover_day, rollover_time):
+    """Record the final standings of finished weeks in weekly_winners
+
+    Every week from the one with the first done chore up to the one
+    before the week containing `now` is recorded, unless it already
+    has been, so weeks missed while nothing was running get filled
+    in.  Standings are frozen once recorded: later changes to a
+    chore's worth don't change them.  Returns the `week_begin`s of
+    the weeks recorded.
+    """
+    first_done = self.session.execute(first_done_chore_statement).scalar()
+    if first_done is None:
+      return []
+    current_week = chores_lib.containing_date_range(
+        now, rollover_day, rollover_time)['begin']
+    week = chores_lib.containing_date_range(
+        first_done, rollover_day, rollover_time)['begin']
+    already_recorded = set(row[0] for row in self.session.execute(
+        recorded_weeks_statement))
+
+    recorded = []
+    with self._transaction():
+      while week < current_week:
+        week_end = week + datetime.timedelta(weeks=1)
+        if week not in already_recorded:
+          # sorted() is stable, so ties go to the lowest rowid like winner()
+          standings = sorted(self.scores_between(week, week_end),
+              key=lambda standing: -standing['week_score'])
+          self.session.execute(insert_standing_statement, [
+            {
+              'week_begin': week, 'week_end': week_end,
+              'user_id': standing['rowid'], 'name': standing['name'],
+              'score': standing['week_score'], 'rank': rank,
+            }
+            for rank, standing in enumerate(standings, 1)
+          ])
+          recorded.append(week)
+        week = week_end
+      if recorded:
+        self.session.commit()
+    return recorded
+
+  def weekly_winners(self, limit=None):
+    """Return recorded winners of finished weeks, most recent first
+
+      [{'week_begin': datetime, 'week_end': datetime, 'user_id': user_id, 'name': name, 'score': score}, ...]
+
+    Weeks in which nobody scored are left out.
+    """
+    # SQLite reads a negative LIMIT as no limit
+    results = self.session.execute(weekly_winners_statement,
+        {'limit': int(limit) if limit else -1})
+    return [
+      {'week_begin': row[0], 'week_end': row[1], 'user_id': row[2],
+          'name': row[3], 'score': row[4]}
+      for row in results
+    ]
+
+  def _forget_standings_at(self, dt):
+    """Drop recorded standings of the week containing `dt`, so it's
+    computed from done chores (and recorded again) after a change
+    """
+    if dt is not None:
+      self.session.execute(forget_standings_statement, {'dt': dt})
+
   def users(self):
     """Return list of users
 
@@ -98,72 +335,186 @@ class chores_controller():
 
     ordered by total score highest to lowest
     """
-    # TODO Use the ORM for this, not a raw SQL statement
-    # The ones in the done_chores table
-    # i.e. they've done a chore
-    results = self.session.query("rowid", "name", "sum(chores.worth)").from_statement(text("""
-      SELECT
-        users.rowid, users.name, sum(chores.worth)
-      FROM
-        done_chores, chores, users
-      WHERE
-        done_chores.user_id = users.rowid
-      AND
-        done_chores.chore_id = chores.rowid
-      GROUP BY
-        users.name
-      ;
-    """))
-    hard_workers = results.all()
-    # The ones who've done nothing yet
-    results = self.session.query("rowid", "name").from_statement(text("SELECT rowid, name, 0 FROM users WHERE rowid NOT IN (SELECT user_id FROM done_chores);"))
-    return list(reversed(sorted(list(
-      {'rowid': x[0], 'name': x[1], 'score': x[2]}
-      for x in hard_workers + [(x[0], x[1], 0) for x in results.all()]
-    ), cmp=lambda a,b: cmp(a['score'], b['score']))))
+    points = self.points()
+    return sorted((
+      {'rowid': rowid, 'name': name, 'score': points.get(rowid, 0)}
+      for rowid, name in sorted(self.catalog.users.items())
+    ), key=lambda user: -user['score'])
+
+  def compact_history(self, before, rollover_day, rollover_time, export_path=None):
+    """Fold done chores from weeks ending before `before` into rollups
+
+    Done chores older than the start of the week containing `before`
+    are counted per user, chore and week into done_chore_rollups and
+    removed from done_chores.  Scores stay the same as long as weeks
+    are asked about with the same `rollover_day` and `rollover_time`.
+    If `export_path` is given, the removed rows are first appended
+    there as gzipped JSON lines.
+
+    Returns {'cutoff': datetime, 'archived': rows removed, 'rollups': rollups touched}
+    """
+    cutoff = chores_lib.containing_date_range(
+        before, rollover_day, rollover_time)['begin']
+    counts = collections.Counter()
+    archived = []
+    export_file = None
+    try:
+      for row in self.session.execute(old_done_chores_statement,
+          {'cutoff': cutoff}):
+        done_chore = done_chore_record._make(row)
+        counts[(done_chore.user_id, int(done_chore.chore_id),
+            week_begin(done_chore.datetime, cutoff))] += 1
+        archived.append({'rowid': done_chore.rowid})
+        if export_path:
+          if export_file is None:
+            export_file = gzip.open(export_path, 'ab')
+          export_file.write((json.dumps({
+            'rowid': done_chore.rowid,
+            'user_id': done_chore.user_id,
+            'chore_id': done_chore.chore_id,
+            'datetime': chores_lib.datetime_to_string(done_chore.datetime),
+          }) + '\n').encode('utf-8'))
+    finally:
+      if export_file:
+        export_file.close()
+
+    if counts:
+      rollups = [
+        {'user_id': user_id, 'chore_id': chore_id, 'week_begin': week, 'count': count}
+        for (user_id, chore_id, week), count in counts.items()
+      ]
+      with self._transaction():
+        self.session.execute(insert_rollup_statement, rollups)
+        self.session.execute(add_to_rollup_statement, rollups)
+        self.session.execute(delete_old_done_chores_statement, {'cutoff': cutoff})
+        self._log_changes('done_chores', 'delete', archived)
+        # Only the latest change to a row is ever sent, so earlier ones
+        # can go
+        self.session.execute(delete_superseded_changes_statement)
+        self.session.commit()
+    return {
+      'cutoff': cutoff,
+      'archived': sum(counts.values()),
+      'rollups': len(counts),
+    }
 
   def rowid(self, name, table_type):
     """Return rowid corresponding to `name` in `table_type`"""
     if table_type == 'user':
-      table = User
+      return self.catalog.user_rowids[name]
     elif table_type == 'chore':
-      table = Chore
+      return self.catalog.chore_rowids[name]
     else:
       raise RuntimeError("Unknown table type " + table_type)
-    return session.query(table.rowid).filter_by(name=name).one()[0]
 
   def user_name(self, rowid):
     """Return name corresponding to `rowid`"""
-    return self.session.query(User.name).filter_by(rowid=rowid).one()[0]
+    return self.catalog.users[int(rowid)]
 
   def delete_done_chore(self, chore_id):
-    self.session.delete(self.session.query(Done_chore).filter_by(rowid=chore_id).one())
-    self.session.commit()
+    done_chore = self.session.execute(done_chore_datetime_statement,
+        {'rowid': chore_id}).first()
+    if done_chore is None:
+      raise NoResultFound("No done chore {0}".format(chore_id))
+    done_datetime, idempotency_key = done_chore
+    with self._transaction():
+      self._forget_standings_at(done_datetime)
+      self.session.execute(delete_done_chore_statement, {'rowid': chore_id})
+      self._log_changes('done_chores', 'delete', [{'rowid': int(chore_id)}])
+      self.session.commit()
+    # So it can be done again
+    self.recent_keys.pop(idempotency_key, None)
 
   def new_chore(self, name, worth):
-    self.session.add(Chore(name=name, worth=worth))
-    self.session.commit()
+    """Add a chore called `name` worth `worth` points
 
-  def new_user(self, name):
-    self.session.add(User(name=name))
-    self.session.commit()
+    Raises ValueError, writing nothing, unless `worth` is a whole
+    number.
+    """
+    worth = whole_number(worth)
+    with self.catalog_lock, self._transaction():
+      result = self.session.execute(insert_chore_statement,
+          {'name': name, 'worth': worth})
+      chore = chore_record(result.inserted_primary_key[0], name, worth)
+      self._log_changes('chores', 'put', [chore._asdict()])
+      self.session.commit()
+      self.catalog = self.catalog.with_chore(chore)
 
-  def new_done_chore(self, user_id, chore_id, dt):
-    self.session.add(Done_chore(user_id=user_id, chore_id=chore_id, datetime=dt))
-    self.session.commit()
+  def new_user(self, name):
+    with self.catalog_lock, self._transaction():
+      result = self.session.execute(insert_user_statement, {'name': name})
+      rowid = result.inserted_primary_key[0]
+      self._log_changes('users', 'put', [{'rowid': rowid, 'name': name}])
+      self.session.commit()
+      self.catalog = self.catalog.with_user(rowid, name)
+
+  def new_done_chore(self, user_id, chore_id, dt, idempotency_key=None):
+    """Record `user_id` having done `chore_id` at `dt`
+
+    Returns False, recording nothing, if a done chore with the same
+    `idempotency_key` already was.  Without one, the key comes from
+    the user, the chore and which `dedupe_window_seconds` long window
+    `dt` falls in, so a double tap or a retry only counts once.  A
+    done chore with the key of the window before or after counts as
+    the same one too, so double taps either side of a window's edge
+    don't count twice.
+    """
+    neighbor_keys = []
+    if idempotency_key is None:
+      idempotency_key, before, after = [
+        derived_idempotency_key(user_id, chore_id, dt,
+            self.dedupe_window_seconds, shift)
+        for shift in (0, -1, 1)
+      ]
+      if idempotency_key is not None:
+        neighbor_keys = [before, after]
+    if any(key in self.recent_keys
+        for key in [idempotency_key] + neighbor_keys if key is not None):
+      return False
+    if neighbor_keys and self.session.execute(neighbor_keys_statement,
+        {'before': neighbor_keys[0], 'after': neighbor_keys[1]}).scalar():
+      return False
+    with self._transaction():
+      self._forget_standings_at(dt)
+      try:
+        result = self.session.execute(insert_done_chore_statement,
+            {'user_id': user_id, 'chore_id': chore_id, 'datetime': dt,
+                'idempotency_key': idempotency_key})
+      except IntegrityError:
+        # Recorded before recent_keys last forgot it
+        self.session.rollback()
+        self._remember_key(idempotency_key)
+        return False
+      self._log_changes('done_chores', 'put', [loggable_done_chore(
+          done_chore_record(rowid=result.inserted_primary_key[0],
+            chore_id=str(chore_id), user_id=int(user_id), datetime=dt))])
+      self.session.commit()
+    self._remember_key(idempotency_key)
+    return True
 
   def delete_user(self, user_id):
-    self.session.delete(self.session.query(User).filter_by(rowid=user_id).one())
-    self.session.commit()
+    with self.catalog_lock, self._transaction():
+      if self.session.execute(delete_user_statement,
+          {'rowid': user_id}).rowcount == 0:
+        raise NoResultFound("No user {0}".format(user_id))
+      self._log_changes('users', 'delete', [{'rowid': int(user_id)}])
+      self.session.commit()
+      self.catalog = self.catalog.without_user(int(user_id))
 
   def delete_chore(self, chore_id):
-    self.session.delete(self.session.query(Chore).filter_by(rowid=chore_id).one())
-    self.session.commit()
+    with self.catalog_lock, self._transaction():
+      if self.session.execute(delete_chore_statement,
+          {'rowid': chore_id}).rowcount == 0:
+        raise NoResultFound("No chore {0}".format(chore_id))
+      self._log_changes('chores', 'delete', [{'rowid': int(chore_id)}])
+      self.session.commit()
+      self.catalog = self.catalog.without_chore(int(chore_id))
 
   def change_chore(self, chore_id, **kwargs):
     """Update name and/or worth of chore `chore_id`
 
-    kwargs can contain name= and/or worth=
+    kwargs can contain name= and/or worth=.  Raises ValueError,
+    writing nothing, if worth isn't a whole number.
     """
     # if ('name' in kwargs) or ('worth' in kwargs):
     to_update = {
@@ -171,17 +522,144 @@ class chores_controller():
       for key, value in kwargs.iteritems()
       if key in ('worth', 'name')
     }
+    if 'worth' in to_update:
+      to_update['worth'] = whole_number(to_update['worth'])
     if to_update:
-      self.session.query(Chore).filter_by(rowid=chore_id).update(
-        to_update)
-      self.session.commit()
-
+      with self.catalog_lock, self._transaction():
+        if int(chore_id) not in self.catalog.chores:
+          # Like an UPDATE matching nothing
+          return
+        params = dict(to_update, chore_id=chore_id)
+        self.session.execute(update_chore_statement, params)
+        chore = self.catalog.chores[int(chore_id)]
+        chore = chore._replace(
+            name=to_update.get('name', chore.name),
+            worth=to_update.get('worth', chore.worth))
+        self._log_changes('chores', 'put', [chore._asdict()])
+        self.session.commit()
+        self.catalog = self.catalog.with_chore(chore)
+
+
+
+###########
+# Catalog #
+###########
+
+class catalog():
+  """Snapshot of the (small, rarely changed) chores and users tables
+
+  `chores` maps rowid to chore_record, `chore_rowids` maps name to
+  rowid, and `users` and `user_rowids` do the same for user names.
+  A catalog is never modified.  Changes make a new one, which the
+  controller swaps in all at once, so readers never see half of a
+  change.
+  """
+  def __init__(self, chores, users):
+    self.chores = dict((chore.rowid, chore._replace(worth=int(chore.worth)))
+        for chore in chores)
+    self.users = dict(users)
+    self.chore_rowids = dict((chore.name, rowid)
+        for rowid, chore in self.chores.items())
+    self.user_rowids = dict((name, rowid) for rowid, name in self.users.items())
+    self.chores_by_worth = sorted(self.chores.values(),
+        key=lambda chore: (-chore.worth, chore.rowid))
+
+  def with_chore(self, chore):
+    """Return a copy with `chore` (a chore_record) added or replaced"""
+    chores = dict(self.chores)
+    chores[chore.rowid] = chore
+    return catalog(chores.values(), self.users.items())
+
+  def without_chore(self, rowid):
+    chores = dict(self.chores)
+    chores.pop(rowid, None)
+    return catalog(chores.values(), self.users.items())
+
+  def with_user(self, rowid, name):
+    users = dict(self.users)
+    users[rowid] = name
+    return catalog(self.chores.values(), users.items())
+
+  def without_user(self, rowid):
+    users = dict(self.users)
+    users.pop(rowid, None)
+    return catalog(self.chores.values(), users.items())
 
 
 ############
 # Database #
 ############
 
+class statement_cache(sqlalchemy.util.LRUCache):
+  """SQLAlchemy compiled_cache counting how often it's hit
+
+  Statements below are built once, so executing one again finds its
+  compiled SQL here instead of being compiled again.  The SQL strings
+  are then identical too, which is what lets sqlite3's own cache of
+  prepared statements (`cached_statements`) skip parsing and
+  planning them.
+  """
+  def __init__(self, capacity=200):
+    sqlalchemy.util.LRUCache.__init__(self, capacity)
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, default=None):
+    compiled = sqlalchemy.util.LRUCache.get(self, key, default)
+    if compiled is default:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return compiled
+
+  def stats(self):
+    """Return {'hits': hits, 'misses': misses, 'hit_rate': hit rate, 'size': statements cached}"""
+    lookups = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+      'size': len(self),
+    }
+
+# Every done chore still in done_chores plus the weekly rollups of
+# compacted ones, as (user_id, chore_id, datetime, count).  Scores
+# should always be summed over this rather than done_chores alone.
+scored_chores = """
+  SELECT user_id, chore_id, datetime, 1 AS count FROM done_chores
+  UNION ALL
+  SELECT user_id, chore_id, week_begin, count FROM done_chore_rollups
+"""
+
+# Number of each chore done by each user, to be multiplied by worths
+# from the catalog
+chore_counts_statement = text("""
+  SELECT
+    user_id, chore_id, sum(count)
+  FROM
+    ({0}) AS scored
+  WHERE
+    datetime >= :begin
+  AND
+    datetime < :end
+  GROUP BY
+    user_id, chore_id
+  ;
+""".format(scored_chores)).bindparams(
+  sqlalchemy.bindparam('begin', type_=DateTime),
+  sqlalchemy.bindparam('end', type_=DateTime),
+)
+
+all_chore_counts_statement = text("""
+  SELECT
+    user_id, chore_id, sum(count)
+  FROM
+    ({0}) AS scored
+  GROUP BY
+    user_id, chore_id
+  ;
+""".format(scored_chores))
+
 Base = declarative_base()
 class User(Base):
   """row of sqlalchemy users Table object"""
@@ -201,18 +679,261 @@ class Done_chore(Base):
   chore_id = Column(Integer, ForeignKey('chores.rowid'))
   user_id = Column(Integer, ForeignKey('users.rowid'))
   datetime = Column(DateTime)
-
-
-
-def chores_db_session(path_to_database):
+  # Unique, see chores_controller.new_done_chore()
+  idempotency_key = Column(String)
+
+class Done_chore_rollup(Base):
+  """row of sqlalchemy done_chore_rollups Table
+
+  `count` done chores of `chore_id` by `user_id` in the week
+  starting `week_begin`, left behind by compact_history()
+  """
+  __tablename__ = 'done_chore_rollups'
+  __table_args__ = (
+    sqlalchemy.UniqueConstraint('user_id', 'chore_id', 'week_begin'),
+  )
+  rowid = Column(Integer, primary_key=True)
+  user_id = Column(Integer, ForeignKey('users.rowid'), nullable=False)
+  chore_id = Column(Integer, ForeignKey('chores.rowid'), nullable=False)
+  week_begin = Column(DateTime, nullable=False)
+  count = Column(Integer, nullable=False)
+
+class Weekly_winner(Base):
+  """row of sqlalchemy weekly_winners Table
+
+  Where `user_id` finished the week starting `week_begin`, recorded
+  by record_weekly_standings().  `rank` 1 is the week's winner.
+  """
+  __tablename__ = 'weekly_winners'
+  __table_args__ = (
+    sqlalchemy.UniqueConstraint('week_begin', 'user_id'),
+  )
+  rowid = Column(Integer, primary_key=True)
+  week_begin = Column(DateTime, nullable=False)
+  week_end = Column(DateTime, nullable=False)
+  user_id = Column(Integer, ForeignKey('users.rowid'), nullable=False)
+  name = Column(String)
+  score = Column(Integer, nullable=False)
+  rank = Column(Integer, nullable=False)
+
+class Change(Base):
+  """row of sqlalchemy changes Table
+
+  Change number `seq` to the row `row_id` of `table_name`: 'put'
+  (`data` is the whole row as JSON) or 'delete'.  AUTOINCREMENT keeps
+  `seq`s from being reused after old changes are dropped.
+  """
+  __tablename__ = 'changes'
+  __table_args__ = {'sqlite_autoincrement': True}
+  seq = Column(Integer, primary_key=True)
+  table_name = Column(String, nullable=False)
+  row_id = Column(Integer, nullable=False)
+  op = Column(String, nullable=False)
+  data = Column(String)
+
+users_table = User.__table__
+chores_table = Chore.__table__
+done_chores_table = Done_chore.__table__
+done_chore_rollups_table = Done_chore_rollup.__table__
+weekly_winners_table = Weekly_winner.__table__
+changes_table = Change.__table__
+
+# Lightweight rows for the read path, skipping the ORM's identity map
+chore_record = collections.namedtuple('chore_record',
+    [column.name for column in chores_table.c])
+# Not every column: idempotency_key is bookkeeping, not part of what
+# done_chores() returns
+done_chore_columns = [done_chores_table.c.rowid, done_chores_table.c.chore_id,
+    done_chores_table.c.user_id, done_chores_table.c.datetime]
+done_chore_record = collections.namedtuple('done_chore_record',
+    [column.name for column in done_chore_columns])
+
+
+
+all_chores_statement = select(chores_table.c)
+all_users_statement = select(users_table.c)
+
+insert_chore_statement = chores_table.insert()
+insert_user_statement = users_table.insert()
+insert_done_chore_statement = done_chores_table.insert()
+update_chore_statement = chores_table.update().where(
+    chores_table.c.rowid == sqlalchemy.bindparam('chore_id'))
+delete_chore_statement = chores_table.delete().where(
+    chores_table.c.rowid == sqlalchemy.bindparam('rowid'))
+delete_user_statement = users_table.delete().where(
+    users_table.c.rowid == sqlalchemy.bindparam('rowid'))
+delete_done_chore_statement = done_chores_table.delete().where(
+    done_chores_table.c.rowid == sqlalchemy.bindparam('rowid'))
+done_chore_datetime_statement = select([done_chores_table.c.datetime,
+    done_chores_table.c.idempotency_key]).where(
+    done_chores_table.c.rowid == sqlalchemy.bindparam('rowid'))
+
+# Keyed by (for one user?, between two datetimes?, most recent first?)
+done_chores_statements = {}
+for by_user in (False, True):
+  for by_datetime in (False, True):
+    for reverse in (False, True):
+      query = select(done_chore_columns)
+      if by_user:
+        query = query.where(
+            done_chores_table.c.user_id == sqlalchemy.bindparam('user_id'))
+      if by_datetime:
+        query = query.where(done_chores_table.c.datetime >=
+            sqlalchemy.bindparam('begin', type_=DateTime)).where(
+            done_chores_table.c.datetime <
+            sqlalchemy.bindparam('end', type_=DateTime))
+      if reverse:
+        query = query.order_by(desc(done_chores_table.c.datetime))
+      else:
+        query = query.order_by(asc(done_chores_table.c.datetime))
+      done_chores_statements[(by_user, by_datetime, reverse)] = query
+del by_user, by_datetime, reverse, query
+
+old_done_chores_statement = select(done_chore_columns).where(
+    done_chores_table.c.datetime < sqlalchemy.bindparam('cutoff', type_=DateTime))
+delete_old_done_chores_statement = done_chores_table.delete().where(
+    done_chores_table.c.datetime < sqlalchemy.bindparam('cutoff', type_=DateTime))
+
+insert_rollup_statement = text("""
+  INSERT OR IGNORE INTO done_chore_rollups (user_id, chore_id, week_begin, count)
+  VALUES (:user_id, :chore_id, :week_begin, 0);
+""").bindparams(sqlalchemy.bindparam('week_begin', type_=DateTime))
+
+add_to_rollup_statement = text("""
+  UPDATE done_chore_rollups SET count = count + :count
+  WHERE user_id = :user_id AND chore_id = :chore_id AND week_begin = :week_begin;
+""").bindparams(sqlalchemy.bindparam('week_begin', type_=DateTime))
+
+first_done_chore_statement = text("""
+  SELECT min(datetime) AS first FROM ({0}) AS scored;
+""".format(scored_chores)).columns(first=DateTime)
+
+recorded_winner_statement = select(
+    [weekly_winners_table.c.name, weekly_winners_table.c.score]).where(
+    sqlalchemy.and_(
+      weekly_winners_table.c.week_begin == sqlalchemy.bindparam('week_begin'),
+      weekly_winners_table.c.rank == 1))
+
+recorded_weeks_statement = select(
+    [weekly_winners_table.c.week_begin]).distinct()
+
+insert_standing_statement = weekly_winners_table.insert()
+
+weekly_winners_statement = select([weekly_winners_table.c.week_begin,
+    weekly_winners_table.c.week_end, weekly_winners_table.c.user_id,
+    weekly_winners_table.c.name, weekly_winners_table.c.score]).where(
+    sqlalchemy.and_(weekly_winners_table.c.rank == 1,
+        weekly_winners_table.c.score > 0)).order_by(
+    desc(weekly_winners_table.c.week_begin)).limit(
+    sqlalchemy.bindparam('limit', type_=Integer))
+
+forget_standings_statement = weekly_winners_table.delete().where(
+    sqlalchemy.and_(
+      weekly_winners_table.c.week_begin <= sqlalchemy.bindparam('dt', type_=DateTime),
+      weekly_winners_table.c.week_end > sqlalchemy.bindparam('dt', type_=DateTime)))
+
+insert_change_statement = changes_table.insert()
+
+latest_change_statement = text("""
+  SELECT coalesce(max(seq), 0) FROM changes;
+""")
+
+changes_statement = text("""
+  SELECT seq, table_name, row_id, op, data
+  FROM changes
+  WHERE seq IN (
+    SELECT max(seq) FROM changes WHERE seq > :since
+    GROUP BY table_name, row_id
+  )
+  ORDER BY seq;
+""")
+
+delete_superseded_changes_statement = text("""
+  DELETE FROM changes WHERE seq NOT IN (
+    SELECT max(seq) FROM changes GROUP BY table_name, row_id
+  );
+""")
+
+done_chores_columns_statement = text("PRAGMA table_info(done_chores);")
+add_idempotency_key_statement = text(
+    "ALTER TABLE done_chores ADD COLUMN idempotency_key TEXT;")
+# Unique indexes allow any number of NULLs, so done chores recorded
+# before there were keys don't get in the way
+idempotency_key_index_statement = text("""
+  CREATE UNIQUE INDEX IF NOT EXISTS done_chores_idempotency_key
+  ON done_chores (idempotency_key);
+""")
+
+# Whether a done chore has either of two idempotency keys, found
+# through their unique index
+neighbor_keys_statement = text("""
+  SELECT count(*) FROM done_chores
+  WHERE idempotency_key IN (:before, :after);
+""")
+
+def derived_idempotency_key(user_id, chore_id, dt, window_seconds, shift=0):
+  """Return a key shared by all done chores of `chore_id` by `user_id`
+  in the same `window_seconds` long window as `dt` (or `shift` windows
+  later), or None if `window_seconds` is 0 or None
+  """
+  if not window_seconds:
+    return None
+  offset = dt - datetime.datetime(1970, 1, 1)
+  window = (offset.days * 86400 + offset.seconds) // int(window_seconds) + shift
+  return hashlib.sha1('{0}:{1}:{2}:{3}'.format(int(user_id), int(chore_id),
+      int(window_seconds), window).encode('utf-8')).hexdigest()
+
+def whole_number(value):
+  """Return `value` (an int, or a string or float of one) as an int,
+  raising ValueError if it isn't a whole number
+  """
+  if isinstance(value, float) and not value.is_integer():
+    raise ValueError("Not a whole number: {0!r}".format(value))
+  try:
+    return int(value)
+  except TypeError:
+    raise ValueError("Not a whole number: {0!r}".format(value))
+
+def loggable_done_chore(done_chore):
+  """Return done_chore_record `done_chore` as a dict that can be JSON"""
+  return {
+    'rowid': done_chore.rowid,
+    'datetime': chores_lib.datetime_to_string(done_chore.datetime),
+    'chore_id': done_chore.chore_id,
+    'user_id': done_chore.user_id,
+  }
+
+def week_begin(dt, boundary):
+  """Return the start of the week containing `dt`, where `boundary`
+  is the start of some week
+  """
+  offset = dt - boundary
+  offset_microseconds = (offset.days * 86400 + offset.seconds) * 10**6 + \
+      offset.microseconds
+  weeks = offset_microseconds // (7 * 86400 * 10**6)
+  return boundary + datetime.timedelta(weeks=weeks)
+
+def chores_db_session(path_to_database, compiled_cache=None):
+  """Return a session on the database at `path_to_database`
+
+  Compiled statements are kept in `compiled_cache` if it's given.
+  Each thread keeps its sqlite3 connection open across commits (rather
+  than the default of reconnecting), and with it sqlite3's cache of
+  prepared statements.
+  """
+  execution_options = {}
+  if compiled_cache is not None:
+    execution_options['compiled_cache'] = compiled_cache
   engine = sqlalchemy.create_engine(
-      'sqlite:///{0}'.format(path_to_database))
+      'sqlite:///{0}'.format(path_to_database),
+      connect_args={'cached_statements': 200},
+      poolclass=sqlalchemy.pool.SingletonThreadPool,
+      execution_options=execution_options)
   Session = sessionmaker(bind=engine)
   return Session()
 
 def get_chore(name, cursor):
-  query = "SELECT name, worth, rowid FROM chores WHERE name='{}';"
-  cursor.execute(query.format(name))
+  cursor.execute("SELECT name, worth, rowid FROM chores WHERE name=?;", (name,))
   first_row = cursor.fetchall()[0]
   if len(first_row) >= 3:
     return {'name': first_row[0], 'worth': first_row[1],
@@ -1,11 +1,86 @@
 import datetime
 from datetime import timedelta
-from dateutil.parser import parse as parse_date
-from dateutil.relativedelta import relativedelta
-import requests
+import importlib
 import json
 import os
-import yaml
+import sys
+import time
+import urllib
+from contextlib import contextmanager
+
+###########
+# Startup #
+###########
+
+# (label, seconds) for each import and initialization step timed
+# while starting up.  Only filled in after profile_startup().
+startup_times = []
+startup_began = None
+
+# Names of modules given to lazy_module()
+deferred_modules = []
+
+@contextmanager
+def timed(label):
+  """Record how long the body takes in `startup_times` as `label`"""
+  began = time.time()
+  try:
+    yield
+  finally:
+    if startup_began is not None:
+      startup_times.append((label, time.time() - began))
+
+def profile_startup():
+  """Start timing every import that isn't nested in another import
+
+  Call this before the imports to be measured.
+  """
+  global startup_began
+  if startup_began is not None:
+    return
+  startup_began = time.time()
+  try:
+    import __builtin__ as builtins
+  except ImportError:
+    import builtins
+  original_import = builtins.__import__
+  depth = [0]
+  def timed_import(name, *args, **kwargs):
+    if depth[0] or name in sys.modules:
+      return original_import(name, *args, **kwargs)
+    depth[0] += 1
+    try:
+      with timed('import ' + name):
+        return original_import(name, *args, **kwargs)
+    finally:
+      depth[0] -= 1
+  builtins.__import__ = timed_import
+
+def startup_report():
+  """Return the timings recorded since profile_startup() as text"""
+  lines = ['Startup profile (seconds):']
+  for label, seconds in startup_times:
+    lines.append('  {0:7.3f}  {1}'.format(seconds, label))
+  lines.append('  {0:7.3f}  total'.format(time.time() - startup_began))
+  not_loaded = [name for name in deferred_modules if name not in sys.modules]
+  if not_loaded:
+    lines.append('Deferred until first use: ' + ', '.join(not_loaded))
+  return '\n'.join(lines)
+
+class lazy_module(object):
+  """Stand-in for module `name`, imported on first attribute access"""
+  def __init__(self, name):
+    self.__dict__['_name'] = name
+    self.__dict__['_module'] = None
+    deferred_modules.append(name)
+
+  def __getattr__(self, attribute):
+    if self._module is None:
+      self.__dict__['_module'] = importlib.import_module(self._name)
+    return getattr(self._module, attribute)
+
+requests = lazy_module('requests')
+yaml = lazy_module('yaml')
 
 api_url = 'http://localhost:8190'
 datetime_conversion_string = "%Y-%m-%d %H:%M:%S.%f"
@@ -14,7 +89,7 @@ def containing_date_range(now, rollover_day_of_week, rollover_time):
 
   # Find next rollover_day_of_week by just adding days until you get there.
   next_rollover = now.replace(hour=rollover_time.hour,
-      minute=rollover_time.minute)
+      minute=rollover_time.minute, second=0, microsecond=0)
   days_forward = 0
   while next_rollover.strftime('%A') != rollover_day_of_week:
     next_rollover += datetime.timedelta(days=1)
@@ -27,16 +102,37 @@ def containing_date_range(now, rollover_day_of_week, rollover_time):
   if now > next_rollover:
     next_rollover += datetime.timedelta(weeks=1)
 
-  prev_rollover = next_rollover - relativedelta(weeks=1)
+  prev_rollover = next_rollover - timedelta(weeks=1)
   return {'begin': prev_rollover, 'end': next_rollover}
 
+def settings():
+  """Settings of the household `api_url` points at
+
+    {'household': name, 'rollover_day': 'Friday', 'rollover_time': datetime.time}
+  """
+  to_return = requests.get(api_url + '/settings').json()['settings']
+  to_return['rollover_time'] = string_to_time(to_return['rollover_time'])
+  return to_return
+
 def chores():
   return requests.get(api_url + '/chores').json()['chores']
 
-def done_chores(user_id, reverse):
-  url = api_url + '/done_chores/' + str(user_id)
+def done_chores(user_id=None, reverse=False, begin=None, end=None):
+  """Done chores of `user_id`, or of everyone if `user_id` is None,
+  from `begin` up to (not including) `end` if they're given
+  """
+  url = api_url + '/done_chores'
+  if user_id is not None:
+    url += '/' + str(user_id)
+  query = []
   if reverse:
-    url += '?reverse=true'
+    query.append(('reverse', 'true'))
+  if begin is not None:
+    query.append(('begin', datetime_to_string(begin)))
+  if end is not None:
+    query.append(('end', datetime_to_string(end)))
+  if query:
+    url += '?' + urllib.urlencode(query)
   to_return = requests.get(url).json()['done_chores']
   
   # Change datetimes from JSON strings to actual datetime
@@ -45,6 +141,17 @@ def done_chores(user_id, reverse):
     done_chore['datetime'] = string_to_datetime(done_chore['datetime'])
   return to_return
 
+def names(timeout=None):
+  """Names of users and chores by rowid, without scores
+
+    {'users': {rowid: name, ...}, 'chores': {rowid: name, ...}}
+  """
+  received = requests.get(api_url + '/names', timeout=timeout).json()['names']
+  return dict(
+    (table, dict((row['rowid'], row['name']) for row in rows))
+    for table, rows in received.items()
+  )
+
 def chore_name(chore_id):
   return requests.get(
       api_url + '/chore_name/' + str(chore_id)).json()['name']
@@ -58,11 +165,30 @@ def weekly_score(user_id, now, rollover_day, rollover_time):
       rollover_time.strftime('%H:%M')))
   return requests.get(url).json()['weekly_score']
 
+def weekly_scores(now, rollover_day, rollover_time):
+  url = '/'.join((api_url, 'weekly_scores', datetime_to_string(now),
+      rollover_day, rollover_time.strftime('%H:%M')))
+  return requests.get(url).json()['weekly_scores']
+
 def winner(now, rollover_day, rollover_time):
   url = '/'.join((api_url, 'winner', datetime_to_string(now),
       rollover_day, rollover_time.strftime('%H:%M')))
   return requests.get(url).json()['winner']
 
+def winners(limit=None):
+  """Winners of finished weeks, most recent first
+
+    [{'week_begin': datetime, 'week_end': datetime, 'user_id': user_id, 'name': name, 'score': score}, ...]
+  """
+  url = api_url + '/winners'
+  if limit:
+    url += '?limit=' + str(limit)
+  to_return = requests.get(url).json()['winners']
+  for winner in to_return:
+    winner['week_begin'] = string_to_datetime(winner['week_begin'])
+    winner['week_end'] = string_to_datetime(winner['week_end'])
+  return to_return
+
 def change_chore(chore_id, **kwargs):
   request_body = {}
   if 'name' in kwargs:
@@ -81,9 +207,65 @@ def new_chore(name, worth):
   url = '/'.join([api_url, 'chores', name, worth])
   requests.put(url)
 
-def new_done_chore(user_id, chore_id, dt):
-  url = '/'.join([api_url, 'done_chores', user_id, chore_id, datetime_to_string(dt)])
-  requests.put(url)
+def new_done_chore(user_id, chore_id, dt, idempotency_key=None, timeout=None):
+  """Record a done chore.  Sending it again with the same
+  `idempotency_key` won't record it twice.
+  """
+  url = '/'.join([api_url, 'done_chores', str(user_id), str(chore_id), datetime_to_string(dt)])
+  headers = {}
+  if idempotency_key is not None:
+    headers['Idempotency-Key'] = idempotency_key
+  return requests.put(url, headers=headers, timeout=timeout)
+
+class mirror():
+  """Local copy of the chores, users and done chores of `api_url`
+
+  sync() brings it up to date, fetching only what changed since the
+  last sync().
+  """
+  def __init__(self):
+    self.version = 0
+    self.tables = {'chores': {}, 'users': {}, 'done_chores': {}}
+
+  def sync(self):
+    """Apply changes since the last sync() and return how many there were"""
+    received = requests.get(
+        api_url + '/changes?since=' + str(self.version)).json()['changes']
+    if received['version'] < self.version:
+      # The API's database was replaced, so start over
+      self.__init__()
+      return self.sync()
+    for change in received['changes']:
+      rows = self.tables.setdefault(change['table'], {})
+      if change['op'] == 'delete':
+        rows.pop(change['rowid'], None)
+      else:
+        row = change['row']
+        if 'datetime' in row:
+          row['datetime'] = string_to_datetime(row['datetime'])
+        rows[change['rowid']] = row
+    self.version = received['version']
+    return len(received['changes'])
+
+  def chores(self):
+    """Like chores(), ordered by worth (highest to lowest)"""
+    return sorted(self.tables['chores'].values(),
+        key=lambda chore: (-chore['worth'], chore['rowid']))
+
+  def users(self):
+    """[{'rowid': rowid, 'name': name}, ...] ordered by rowid"""
+    return sorted(self.tables['users'].values(),
+        key=lambda user: user['rowid'])
+
+  def done_chores(self, user_id=None, reverse=False, begin=None, end=None):
+    """Like done_chores()"""
+    return sorted((
+      done_chore for done_chore in self.tables['done_chores'].values()
+      if (user_id is None or done_chore['user_id'] == int(user_id))
+      and (begin is None or done_chore['datetime'] >= begin)
+      and (end is None or done_chore['datetime'] < end)
+    ), key=lambda done_chore: (done_chore['datetime'], done_chore['rowid']),
+        reverse=reverse)
 
 # .isoformat() can't be easily converted back to a datetime
 # object!
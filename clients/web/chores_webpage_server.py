@@ -3,77 +3,65 @@
 """chores_webpage_server.py
 
 Usage:
-  chores.py [<path/to/config_file.yaml>]
+  chores.py [--profile-startup] [<path/to/config_file.yaml>]
   chores.py (-h | --help)
   chores.py --version
   chores.py --config-skeleton
+  chores.py --fetch-assets
 
 Options:
   -h --help                 Show this screen.
   --version                 Show version.
   path/to/config_file.yaml  Where preferences are stored [DEFAULT: "~/.config/chores_webpage_serverrc.yaml"]
   --config-skeleton         Print out contents of a reasonable config file.
+  --profile-startup         Print how long each import and initialization step took before serving.
+  --fetch-assets            Download jQuery, jQuery Mobile and Font Awesome to serve them locally, and compress all static assets ahead of time.
 """
 
 version = '1.0.0'
 
+import sys
+from chores_lib import chores_lib
+if '--profile-startup' in sys.argv:
+  chores_lib.profile_startup()
+
 import bottle
 import json
 import datetime
 from datetime import timedelta
-from dateutil.parser import parse as parse_date
-from dateutil.relativedelta import relativedelta
-import urllib
+import time
 import urlparse
-import qrcode
 import os
+import threading
+import zlib
 from docopt import docopt
-from furl import furl
-from chores_lib.chores_lib import chores, done_chores, chore_name, weekly_score, users, winner, delete_done_chore, new_chore, new_done_chore, change_chore, config_file_variables, containing_date_range
-
-########
-# HTML #
-########
+from clients.web import scan_queue, static_assets
+from chores_lib.chores_lib import lazy_module
+# Only needed once someone asks for a QR code or a page, so not
+# worth slowing down startup for
+qrcode = lazy_module('qrcode')
+furl = lazy_module('furl')
+from chores_lib.chores_lib import settings, chores, done_chores, weekly_scores, users, winner, delete_done_chore, new_chore, new_done_chore, change_chore, names, config_file_variables, containing_date_range
 
 html_root = os.path.join('clients', 'web')
 
-def chore_form(user, dt=None):
-  """
-  Generator yielding a form containing new chores to claim
-  `user` has done at datetime `dt`.
-  """
-  if not dt:
-    dt = datetime.datetime.now()
-  yield '<form method="POST" action="./" id="impatient_chore_form">'
-  yield '''<label for="new_done_chore_chore_id_user_{0}" class="select">Chore for {1}</label>
-<select name="new_done_chore_chore_id" id="new_done_chore_chore_id_user_{0}" data-mini="true" data-inline="true">'''.format(
-    user['rowid'],
-    user['name']
-  )
-  for chore in chores():
-    yield '<option name="{0}" value="{0}">{1} ({2})</option>'.format(chore['rowid'], chore['name'], chore['worth'])
-  yield '</select>'
-  yield '<input type="text" name="new_done_chore_user_id" value="{}" style="visibility:hidden;width:2px;height:2px;"/>'.format(
-    user['rowid']
-  )
-  yield '<input type="text" name="new_done_chore_date" value="{}" style="visibility:hidden;width:2px;height:2px;"/>'.format(
-    dt.strftime('%Y-%m-%d')
-  )
-  yield '<input type="text" name="new_done_chore_time" value="{}" style="visibility:hidden;width:2px;height:2px;"/>'.format(
-    dt.strftime('%H:%M:%S')
-  )
-  yield '<input type="submit" style="width:100%;font-size:96px;height:250px;" value="Add"/>'
-  yield '</form>'
+#############
+# Templates #
+#############
 
+# Every fragment of the page is defined once here, at import.  Static
+# fragments are plain strings and the rest are bound str.format
+# methods.  str.format still parses its string on every call, but
+# that is done in C and beats any substitution done in Python.
 
-def done_chores_list_html(user):
-  """Generator yielding the done chores with popups for deletion"""
-  for done_chore in done_chores(user_id=user['rowid'], reverse=True):
-    yield '<li data-icon="delete">{0} {2}<a href="/#done_chore_{1}_popup" data-rel="popup"  data-transition="pop"></a></li>'.format(
-      chore_name(done_chore['chore_id']), done_chore['rowid'],
-      done_chore['datetime'].strftime('%a %-m/%-d'),
-    )
-    yield """
+chore_form_select_html = '''<label for="new_done_chore_chore_id_user_{0}" class="select">Chore for {1}</label>
+<select name="new_done_chore_chore_id" id="new_done_chore_chore_id_user_{0}" data-mini="true" data-inline="true">'''.format
+chore_option_html = '<option name="{0}" value="{0}">{1} ({2})</option>'.format
+hidden_input_html = '<input type="text" name="{0}" value="{1}" style="visibility:hidden;width:2px;height:2px;"/>'.format
+chore_form_submit_html = '<input type="submit" style="width:100%;font-size:96px;height:250px;" value="Add"/>'
+
+done_chore_item_html = '<li data-icon="delete">{0} {2}<a href="/#done_chore_{1}_popup" data-rel="popup"  data-transition="pop"></a></li>'.format
+done_chore_popup_html = """
       <div data-role="popup" id="done_chore_{0}_popup" data-overlay-theme="b" data-theme="b" data-dismissible="false">
         <div data-role="header" data-theme="a">
           <h1>Delete chore</h1>
@@ -83,104 +71,37 @@ def done_chores_list_html(user):
           <a href="#" class="ui-btn ui-corner-all ui-shadow ui-btn-inline ui-btn-b" data-rel="back">Cancel</a>
           <a href="/?delete_done_chore_id={0}" class="ui-btn ui-corner-all ui-shadow ui-btn-inline ui-btn-b" data-transition="flow">Delete</a>
         </div>
-      </div>""".format(done_chore['rowid'])
+      </div>""".format
 
-def users_list_div(now, rollover_day, rollover_time):
-  """Div containing the list of users"""
-  max_weekly_score = max(weekly_score(
-      user['rowid'], now, rollover_day, rollover_time)
-      for user in users())
-  max_width_percent = 50
-  for user in users():
-
-    user_weekly_score = weekly_score(user['rowid'], now, rollover_day,
-        rollover_time)
-    if max_weekly_score > 0:
-      bar_width = max_width_percent * float(user_weekly_score) / float(max_weekly_score)
-    else:
-      bar_width = max_width_percent / 20
-
-    yield '<div data-role="collapsible">'
-    yield '  <h2><span style="width:30%;display:inline-block;">{0}: </span><div class="animated slideInRight" style="width:{2}%;border-style:solid;border-width:3px;display:inline-block;text-align:right;background:#99ffff;padding-right:.5em;"> {1}</div></h2>'.format(
-        user['name'], user_weekly_score, bar_width)
-    yield '''
+user_score_html = '  <h2><span style="width:30%;display:inline-block;">{0}: </span><div class="animated slideInRight" style="width:{2}%;border-style:solid;border-width:3px;display:inline-block;text-align:right;background:#99ffff;padding-right:.5em;"> {1}</div></h2>'.format
+user_chores_html = '''
       <ul data-role="listview">
       <li>Enter new chore<a href="#new_done_chore_popup_user_{0}" data-rel="popup" data-position-to="window" class="ui-btn ui-corner-all ui-shadow ui-btn-inline ui-icon-check ui-btn-icon-left ui-btn-a" data-transition="pop"></a></li>
       <div data-role="popup" id="new_done_chore_popup_user_{0}" data-theme="a" class="ui-corner-all">
-    '''.format(user['rowid'])
-    for formline in chore_form(user):
-      yield formline
-    yield '</div>'
-    for line in done_chores_list_html(user):
-      yield line
-    yield "</ul></div>"
-
-def users_choose_div():
-  """Div containing the list of users for setting a cookie"""
-  for user in users():
-    yield "<div>"
-    yield '<p><a href="/?set_user_id_cookie={1}" class="ui-btn ui-shadow ui-corner-all">{0}</a></p>'.format(user['name'], user['rowid'])
-    yield "</div>"
+    '''.format
+choose_user_html = '<p><a href="/?set_user_id_cookie={1}" class="ui-btn ui-shadow ui-corner-all">{0}</a></p>'.format
 
-def main_page(now):
-  """Generator yielding the html for the "main page" part of the
-  monolithic jquerymobile page.
-  """
-  rollover_day = 'Friday'
-  rollover_time =  datetime.time(6, 0)
-  date_range = containing_date_range(now, rollover_day, rollover_time)
-  previous_date_range = {
-      'begin': date_range['begin'] - relativedelta(weeks=1),
-      'end': date_range['end'] - relativedelta(weeks=1),
-  }
-  yield """
+main_page_header_html = """
     <div data-role="page" id="main_page">
       <div data-role="collapsibleset">
         <p><a href="#chores_management_page" class="ui-btn ui-shadow ui-corner-all"><i class="fa fa-cog"></i> Manage Chores</a></p>
   """
-  date_format = '%a %-m/%-d %-I:%M%P'
-  last_week = now - relativedelta(weeks=1)
-  next_week = now + relativedelta(weeks=1)
-  last_weeks_winner = winner(last_week, rollover_day, rollover_time)
-  yield '<p>Last weeks winner: {0} with {1} points</p>'.format(
-      last_weeks_winner['name'], last_weeks_winner['score'])
-  yield '<p>{0} - {1}</p>'.format(date_range['begin'].strftime(date_format),
-      date_range['end'].strftime(date_format))
-  for line in users_list_div(now, rollover_day, rollover_time):
-    yield line
-
-  # Navigate buttons for prev/next week
-  prev_week_url = furl(bottle.request.url)
-  prev_week_url.args['datetime'] = last_week.strftime('%Y-%m-%d %H:%M:%S')
-  prev_week_url = prev_week_url.url
-  next_week_url = furl(bottle.request.url)
-  next_week_url.args['datetime'] = next_week.strftime('%Y-%m-%d %H:%M:%S')
-  next_week_url = next_week_url.url
-  yield '<a href="{0}" data-role="button" data-icon="arrow-l">Previous Week</a>'.format(prev_week_url)
-  yield '<a href="{0}" data-role="button" data-icon="arrow-r" data-iconpos="right">Next Week</a>'.format(next_week_url)
-  yield """
+last_weeks_winner_html = '<p>Last weeks winner: {0} with {1} points</p>'.format
+date_range_html = '<p>{0} - {1}</p>'.format
+previous_week_html = '<a href="{0}" data-role="button" data-icon="arrow-l">Previous Week</a>'.format
+next_week_html = '<a href="{0}" data-role="button" data-icon="arrow-r" data-iconpos="right">Next Week</a>'.format
+page_footer_html = """
       </div>
     </div><!-- /content -->
   </div><!-- /page -->
   """
 
-def chore_url(chore_id):
-  return urlparse.urljoin(bottle.request.url, '/postget/?new_done_chore_chore_id={0}'.format(chore_id))
-
-def chore_qrcode_url(chore_id):
-  return '/qrcodes/{0}.png'.format(chore_id)
-
-def chores_management_page():
-  """Generator yielding the html for the "chores management page"
-  part of the monolithic jquerymobile page.
-  """
-  yield """
+chores_management_header_html = """
     <div data-role="page" id="chores_management_page">
     <div data-role="collapsibleset">
     <p><a href="#main_page" class="ui-btn ui-shadow ui-corner-all"><i class="fa fa-arrow-left"></i> Back to Main Page</a></p>
   """
-  for chore in chores():
-    yield """<div data-role="collapsible">
+manage_chore_html = """<div data-role="collapsible">
           <h2>{0}</h2>
           <form method="POST" action="./">
             <ul data-role="listview" data-divider-theme="b">
@@ -199,8 +120,8 @@ def chores_management_page():
             </ul>
           </form>
         </div>
-    """.format(chore['name'], chore['rowid'], chore['worth'], chore_qrcode_url(chore['rowid']))
-  yield """
+    """.format
+new_chore_form_html = """
           <h2>Add New Chore</h2>
           <form method="POST" action="./">
             <ul data-role="listview" data-divider-theme="b">
@@ -220,49 +141,237 @@ def chores_management_page():
 </div><!-- /page -->
   """
 
-def cookie_setting_page():
-  """Generator yielding the html for the "identify device" part of the
-  monolithic jquerymobile page.
-  """
-  yield """
+cookie_setting_header_html = """
     <div data-role="page" id="identify_device">
       <div data-role="collapsibleset">
   """
-  yield '<h1>Who are you?</h1>'
-  for line in users_choose_div():
-    yield line
-  yield """
-      </div>
-    </div><!-- /content -->
-  </div><!-- /page -->
-  """
-
 
-def complete_page(now):
-  yield """
+document_head_html = """
     <!doctype html>
     <html>
     <head>
     <title>Chores</title>
     <meta name="viewport" content="width=device-width, initial-scale=1">
-    <link rel="stylesheet" href="http://code.jquery.com/mobile/1.2.0/jquery.mobile-1.2.0.min.css">
-    <link rel="stylesheet" href="animate.min.css">
-    <script src="http://code.jquery.com/jquery-1.8.2.min.js"></script>
-    <script src="http://code.jquery.com/mobile/1.2.0/jquery.mobile-1.2.0.min.js"></script>
-    <link rel="stylesheet" href="//maxcdn.bootstrapcdn.com/font-awesome/4.3.0/css/font-awesome.min.css">
+    <link rel="stylesheet" href="{jquery_mobile_css}">
+    <link rel="stylesheet" href="{animate_css}">
+    <script src="{jquery_js}"></script>
+    <script src="{jquery_mobile_js}"></script>
+    <link rel="stylesheet" href="{font_awesome_css}">
     </head>
     <body>
+  """.format
+# Paths (see static_assets) of what document_head_html loads
+head_assets = {
+  'jquery_mobile_css': 'vendor/jquery.mobile-1.2.0/jquery.mobile-1.2.0.min.css',
+  'animate_css': 'css/animate.min.css',
+  'jquery_js': 'vendor/jquery-1.8.2/jquery-1.8.2.min.js',
+  'jquery_mobile_js': 'vendor/jquery.mobile-1.2.0/jquery.mobile-1.2.0.min.js',
+  'font_awesome_css': 'vendor/font-awesome-4.3.0/css/font-awesome.min.css',
+}
+document_foot_html = """
+</body>
+</html>
+  """
+
+########
+# HTML #
+########
+
+def chore_form(user, all_chores, dt=None):
+  """
+  Generator yielding a form containing new chores (from
+  `all_chores`) to claim `user` has done at datetime `dt`.
+  """
+  if not dt:
+    dt = datetime.datetime.now()
+  yield '<form method="POST" action="./" id="impatient_chore_form">'
+  yield chore_form_select_html(user['rowid'], user['name'])
+  for chore in all_chores:
+    yield chore_option_html(chore['rowid'], chore['name'], chore['worth'])
+  yield '</select>'
+  yield hidden_input_html('new_done_chore_user_id', user['rowid'])
+  yield hidden_input_html('new_done_chore_date', dt.strftime('%Y-%m-%d'))
+  yield hidden_input_html('new_done_chore_time', dt.strftime('%H:%M:%S'))
+  yield chore_form_submit_html
+  yield '</form>'
+
+
+def done_chores_list_html(user_done_chores, chore_names):
+  """Generator yielding the done chores with popups for deletion
+
+  `chore_names` maps chore rowids to names
+  """
+  for done_chore in user_done_chores:
+    yield done_chore_item_html(
+      chore_names.get(int(done_chore['chore_id'])), done_chore['rowid'],
+      done_chore['datetime'].strftime('%a %-m/%-d'),
+    )
+    yield done_chore_popup_html(done_chore['rowid'])
+
+def users_list_div(now, rollover_day, rollover_time):
+  """Div containing the list of users and what they did the week
+  containing `now`
+  """
+  # Fetch everything up front so the number of API calls doesn't
+  # grow with the number of users or done chores.  Only the week
+  # shown, so it doesn't grow with the household's history either.
+  all_users = users()
+  all_chores = chores()
+  chore_names = dict((chore['rowid'], chore['name']) for chore in all_chores)
+  week_scores = dict((score['rowid'], score['week_score'])
+      for score in weekly_scores(now, rollover_day, rollover_time))
+  date_range = containing_date_range(now, rollover_day, rollover_time)
+  done_chores_by_user = {}
+  for done_chore in done_chores(reverse=True, begin=date_range['begin'],
+      end=date_range['end']):
+    done_chores_by_user.setdefault(done_chore['user_id'], []).append(done_chore)
+
+  max_weekly_score = max(week_scores.get(user['rowid'], 0)
+      for user in all_users)
+  max_width_percent = 50
+  for user in all_users:
+
+    user_weekly_score = week_scores.get(user['rowid'], 0)
+    if max_weekly_score > 0:
+      bar_width = max_width_percent * float(user_weekly_score) / float(max_weekly_score)
+    else:
+      bar_width = max_width_percent / 20
+
+    yield '<div data-role="collapsible">'
+    yield user_score_html(user['name'], user_weekly_score, bar_width)
+    yield user_chores_html(user['rowid'])
+    for formline in chore_form(user, all_chores):
+      yield formline
+    yield '</div>'
+    for line in done_chores_list_html(
+        done_chores_by_user.get(user['rowid'], []), chore_names):
+      yield line
+    yield "</ul></div>"
+
+def users_choose_div():
+  """Div containing the list of users for setting a cookie"""
+  # Just names, which the API has in memory, unlike users() and its
+  # scores
+  for rowid, name in sorted(names()['users'].items()):
+    yield "<div>"
+    yield choose_user_html(name, rowid)
+    yield "</div>"
+
+def main_page(now, url):
+  """Generator yielding the html for the "main page" part of the
+  monolithic jquerymobile page at `url`.
+  """
+  household_settings = settings()
+  rollover_day = household_settings['rollover_day']
+  rollover_time = household_settings['rollover_time']
+  date_range = containing_date_range(now, rollover_day, rollover_time)
+  previous_date_range = {
+      'begin': date_range['begin'] - timedelta(weeks=1),
+      'end': date_range['end'] - timedelta(weeks=1),
+  }
+  yield main_page_header_html
+  date_format = '%a %-m/%-d %-I:%M%P'
+  last_week = now - timedelta(weeks=1)
+  next_week = now + timedelta(weeks=1)
+  last_weeks_winner = winner(last_week, rollover_day, rollover_time)
+  yield last_weeks_winner_html(
+      last_weeks_winner['name'], last_weeks_winner['score'])
+  yield date_range_html(date_range['begin'].strftime(date_format),
+      date_range['end'].strftime(date_format))
+  for line in users_list_div(now, rollover_day, rollover_time):
+    yield line
+
+  # Navigate buttons for prev/next week
+  prev_week_url = furl.furl(url)
+  prev_week_url.args['datetime'] = last_week.strftime('%Y-%m-%d %H:%M:%S')
+  prev_week_url = prev_week_url.url
+  next_week_url = furl.furl(url)
+  next_week_url.args['datetime'] = next_week.strftime('%Y-%m-%d %H:%M:%S')
+  next_week_url = next_week_url.url
+  yield previous_week_html(prev_week_url)
+  yield next_week_html(next_week_url)
+  yield page_footer_html
+
+def chore_url(chore_id):
+  return urlparse.urljoin(bottle.request.url, '/postget/?new_done_chore_chore_id={0}'.format(chore_id))
+
+def chore_qrcode_url(chore_id):
+  return '/qrcodes/{0}.png'.format(chore_id)
+
+def chores_management_page():
+  """Generator yielding the html for the "chores management page"
+  part of the monolithic jquerymobile page.
   """
-  for line in main_page(now):
+  yield chores_management_header_html
+  for chore in chores():
+    yield manage_chore_html(chore['name'], chore['rowid'], chore['worth'], chore_qrcode_url(chore['rowid']))
+  yield new_chore_form_html
+
+def cookie_setting_page():
+  """Generator yielding the html for the "identify device" part of the
+  monolithic jquerymobile page.
+  """
+  yield cookie_setting_header_html
+  yield '<h1>Who are you?</h1>'
+  for line in users_choose_div():
+    yield line
+  yield page_footer_html
+
+
+def document_head():
+  """Head of every page, loading assets from their hashed URLs"""
+  return document_head_html(**dict(
+      (name, assets.url(path)) for name, path in head_assets.items()))
+
+def complete_page(now, url):
+  """Generator yielding the whole page at `url`"""
+  yield document_head()
+  for line in main_page(now, url):
     yield line
   for line in chores_management_page():
     yield line
   for line in cookie_setting_page():
     yield line
-  yield """
-</body>
-</html>
+  yield document_foot_html
+
+def stream(pieces, chunk_size=8192):
+  """Generator yielding `pieces` joined by newlines as utf-8 encoded
+  chunks of about `chunk_size` characters
+
+  The first piece is sent on its own so the browser can start
+  loading stylesheets and scripts while the rest is rendered.
   """
+  buffered = []
+  buffered_size = 0
+  for i, piece in enumerate(pieces):
+    if i:
+      buffered.append('\n')
+    buffered.append(piece)
+    buffered_size += len(piece) + 1
+    if i == 0 or buffered_size >= chunk_size:
+      yield u''.join(buffered).encode('utf-8')
+      buffered = []
+      buffered_size = 0
+  if buffered:
+    yield u''.join(buffered).encode('utf-8')
+
+def compressed(chunks):
+  """Return `chunks` gzipped if the browser accepts that"""
+  bottle.response.add_header('Vary', 'Accept-Encoding')
+  if 'gzip' not in static_assets.accepted_encodings(
+      bottle.request.headers.get('Accept-Encoding')):
+    return chunks
+  bottle.response.set_header('Content-Encoding', 'gzip')
+  return gzipped(chunks)
+
+def gzipped(chunks):
+  """Generator gzipping `chunks`, flushing after each one so the page
+  head still reaches the browser before the rest is rendered
+  """
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  for chunk in chunks:
+    yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+  yield compressor.flush()
 
 
 @bottle.get('/')
@@ -278,22 +387,28 @@ def get_whole_page():
   if bottle.request.query.get('set_user_id_cookie'):
     set_user_id_cookie(bottle.response, int(bottle.request.query.get('set_user_id_cookie')))
   if bottle.request.query.get('datetime'):
-    return '\n'.join(list(complete_page(
-        datetime.datetime.strptime(bottle.request.query.get('datetime'),
-            "%Y-%m-%d %H:%M:%S"))))
+    now = datetime.datetime.strptime(bottle.request.query.get('datetime'),
+        "%Y-%m-%d %H:%M:%S")
   else:
-    return '\n'.join(list(complete_page(
-        datetime.datetime.now())))
+    now = datetime.datetime.now()
+  return compressed(stream(complete_page(now, bottle.request.url)))
+
 
+# Anything in static_assets, under the URL document_head() gives it.
+# The URL changes whenever the file does, so it can be cached forever.
+@bottle.get('/assets/<digest>/<path:path>')
+def return_hashed_asset(digest, path):
+  found = assets.get(path)
+  if found is None or found.digest != digest:
+    bottle.abort(404, 'No such asset')
+  return send_asset(found, 'public, max-age=31536000, immutable')
 
 # Serve the css necessary for the date and time pickers
-# TODO Just do this with a static file directive
 @bottle.get('/lib/themes/<a_css_file>')
 def return_css_file(a_css_file):
   if a_css_file in ("default.css", "default.date.css", "default.time.css"):
-    local_file = os.path.join(html_root, 'picker', 'compressed', 'themes', a_css_file)
-    with open(local_file) as f:
-      return f.read()
+    return send_asset(assets.get('picker/themes/' + a_css_file),
+        'public, max-age=3600')
 
 @bottle.get('/qrcodes/<chore_id>.png')
 def return_qrcode_png(chore_id):
@@ -313,6 +428,7 @@ def post_whole_page():
   # Add a new chore
   if bottle.request.forms.get('new_chore_name') and bottle.request.forms.get('new_chore_worth'):
     new_chore(name=bottle.request.forms.get('new_chore_name'), worth=bottle.request.forms.get('new_chore_worth'))
+    catalog.forget()
   # Add a new user
   if bottle.request.forms.get('new_user_name'):
     new_user(name=bottle.request.forms.get('new_user_name').strip())
@@ -338,11 +454,31 @@ def post_whole_page():
         chore_id=int(gets[2]), name=gets[0],
         worth=gets[1]
     )
-  return '\n'.join(list(complete_page(datetime.datetime.now())))
-
+    catalog.forget()
+  return compressed(stream(complete_page(datetime.datetime.now(), bottle.request.url)))
+
+
+scan_confirmation_page = """<!doctype html>
+<html>
+<head>
+<title>Chores</title>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+</head>
+<body style="font-family:sans-serif;text-align:center;">
+<h1>&#10004; {0}</h1>
+<p>Recorded for {1}.</p>
+<p><a href="/">See the scores</a></p>
+</body>
+</html>
+"""
 
 # GET version of what REST says should be a POST so that chores can be submitted by a URL
 # e.g. from a QR Code
+#
+# This is hit by phones scanning QR codes and tapping NFC tags, so it
+# only checks the scan against cached users and chores, queues it
+# for the background worker to send to the API and answers with a
+# tiny page right away.
 @bottle.get('/postget/')
 def post_get():
   # Try to make this not cache so that the same chore can be loaded twice in succession
@@ -361,25 +497,32 @@ def post_get():
     timey = gotten['new_done_chore_time']
   else:
     timey = datetime.datetime.now().strftime('%H:%M:%S')
-  if ('new_done_chore_user_id' in gotten) and ('new_done_chore_chore_id' in gotten):
-    new_done_chore(
-      user_id=gotten['new_done_chore_user_id'],
-      chore_id=gotten['new_done_chore_chore_id'],
-      dt=datetime.datetime.strptime("{} {}".format(datey, timey), "%Y-%m-%d %H:%M:%S")
-    )
-    return '\n'.join(list(complete_page(datetime.datetime.now())))
-  # If no user_id given in GET, but they've got a cookie with their user_id, use that
-  elif 'new_done_chore_chore_id' in gotten:
+  if 'new_done_chore_chore_id' not in gotten:
+    return
+  if 'new_done_chore_user_id' in gotten:
+    user_id = gotten['new_done_chore_user_id']
+  else:
+    # If no user_id given in GET, but they've got a cookie with their user_id, use that
     user_id = user_id_from_cookie(bottle.request.cookies)
-    if user_id:
-      new_done_chore(
-        user_id=user_id,
-        chore_id=gotten['new_done_chore_chore_id'],
-        dt=datetime.datetime.strptime("{} {}".format(datey, timey), "%Y-%m-%d %H:%M:%S")
-      )
-      return '\n'.join(list(complete_page(datetime.datetime.now())))
-    # If no cookie found with a valid id, demand user identify themselves
-    bottle.redirect("/#identify_device")
+    if not user_id:
+      # If no cookie found with a valid id, demand user identify themselves
+      bottle.redirect("/#identify_device")
+  try:
+    user_id = int(user_id)
+    chore_id = int(gotten['new_done_chore_chore_id'])
+  except ValueError:
+    bottle.abort(404, 'No such user or chore')
+  user_name = catalog.user_name(user_id)
+  chore_name = catalog.chore_name(chore_id)
+  if (user_name is None or chore_name is None) and catalog.known():
+    bottle.abort(404, 'No such user or chore')
+  # Without up to date names, queue it anyway: the API turns away
+  # unknown users and chores and the worker then drops the scan
+  scans.put(user_id, chore_id,
+      datetime.datetime.strptime("{} {}".format(datey, timey), "%Y-%m-%d %H:%M:%S"))
+  return scan_confirmation_page.format(
+      chore_name or 'Chore {0}'.format(chore_id),
+      user_name or 'user {0}'.format(user_id))
 
 
 #############
@@ -387,13 +530,94 @@ def post_get():
 #############
 
 
+class catalog_cache():
+  """Names of users and chores by rowid, fetched from the API at most
+  every `ttl` seconds
+
+  Fetching happens in the background, waiting at most `timeout`
+  seconds for the API, and the last names fetched are used meanwhile,
+  so looking up a name never waits for the API.
+  """
+  def __init__(self, ttl=60, timeout=5):
+    self.ttl = ttl
+    self.timeout = timeout
+    self.fetched_at = None
+    self.reachable = False
+    self.user_names = {}
+    self.chore_names = {}
+    # Held while a refresh is running
+    self.refreshing = threading.Lock()
+
+  def refresh(self):
+    """Fetch names of users and chores, returning whether that worked"""
+    try:
+      fetched = names(timeout=self.timeout)
+    except (IOError, ValueError):
+      self.reachable = False
+      return False
+    self.user_names, self.chore_names = fetched['users'], fetched['chores']
+    self.fetched_at = time.time()
+    self.reachable = True
+    return True
+
+  def refresh_in_background(self):
+    """Start refresh() in a thread unless one is already running"""
+    if not self.refreshing.acquire(False):
+      return
+    def run():
+      try:
+        self.refresh()
+      finally:
+        self.refreshing.release()
+    thread = threading.Thread(target=run, name='catalog_refresh')
+    thread.daemon = True
+    thread.start()
+
+  def known(self):
+    """Whether the names are fresh enough to turn away unknown rowids"""
+    return self.reachable and self.fetched_at is not None and \
+        time.time() - self.fetched_at <= self.ttl
+
+  def _name(self, names, rowid):
+    age = time.time() - self.fetched_at if self.fetched_at else None
+    if age is None or age > self.ttl:
+      self.refresh_in_background()
+    elif rowid not in getattr(self, names) and age > 1:
+      # Maybe it was just added
+      self.refresh_in_background()
+    return getattr(self, names).get(rowid)
+
+  def user_name(self, rowid):
+    """Return name of user `rowid`, or None if there's no such user"""
+    return self._name('user_names', rowid)
+
+  def chore_name(self, rowid):
+    """Return name of chore `rowid`, or None if there's no such chore"""
+    return self._name('chore_names', rowid)
+
+  def forget(self):
+    """Fetch from the API next time, e.g. after changing a chore"""
+    self.fetched_at = None
+
+catalog = catalog_cache()
+
+# scan_queue.scan_queue of done chores waiting to be sent, set up by main()
+scans = None
+default_scan_queue_path = os.path.join(os.path.expanduser("~"), ".config",
+    "chores_scan_queue.sqlite")
+
+def send_scan(user_id, chore_id, dt):
+  """Send a queued scan to the API, returning its HTTP status code"""
+  return new_done_chore(user_id=user_id, chore_id=chore_id, dt=dt,
+      timeout=catalog.timeout).status_code
+
 def user_id_from_cookie(cookies):
   """
   `cookies` will be bottle.request.cookies
   """
   if 'chores_id' in cookies:
     purported_user_id = int(cookies['chores_id'])
-    if purported_user_id in (user['rowid'] for user in users()):
+    if catalog.user_name(purported_user_id) is not None or not catalog.known():
       return purported_user_id
   return None
 
@@ -403,22 +627,66 @@ def set_user_id_cookie(response, user_id):
   """
   response.set_cookie("chores_id", str(user_id), expires=datetime.datetime.strptime("3030-01-01", "%Y-%m-%d"))
 
+assets = static_assets.asset_bundle({
+  '': os.path.join(html_root, 'static'),
+  'picker/themes/': os.path.join(html_root, 'picker', 'compressed', 'themes'),
+}, cache_dir=os.path.join(html_root, 'compressed_assets'))
+
+def send_asset(found, cache_control):
+  """Return the best encoding of asset `found` for bottle.request"""
+  if found is None:
+    bottle.abort(404, 'No such asset')
+  etag = '"{0}"'.format(found.digest)
+  bottle.response.set_header('Cache-Control', cache_control)
+  bottle.response.set_header('ETag', etag)
+  bottle.response.set_header('Vary', 'Accept-Encoding')
+  if bottle.request.headers.get('If-None-Match') == etag:
+    bottle.response.status = 304
+    return b''
+  encoding, body = static_assets.choose_encoding(found,
+      bottle.request.headers.get('Accept-Encoding'))
+  bottle.response.content_type = found.content_type
+  if encoding != 'identity':
+    bottle.response.set_header('Content-Encoding', encoding)
+  return body
+
 # Static route to animate.css
 @bottle.get('/<filename:re:.*\.css>')
 def stylesheets(filename):
-  return bottle.static_file(filename, root=os.path.join(html_root,'static', 'css'))
+  return send_asset(assets.get('css/' + filename), 'public, max-age=3600')
 
 def main():
-  arguments = docopt(__doc__, version=version)
+  with chores_lib.timed('parse arguments'):
+    arguments = docopt(__doc__, version=version)
 
   default_config_skeleton = """host_name: localhost
 port: 8090
-debug_mode: True"""
+debug_mode: True
+# Add /households/<name> to serve one household of a
+# multi-household chores_api
+api_url: {0}
+# Scanned chores wait here until the API has them.  Web servers for
+# other households can share it: each only sends its own api_url's.
+scan_queue_path: {1}
+# How long (in seconds) to trust the cached list of users and chores
+# when checking scans
+catalog_ttl_seconds: 60
+# How long (in seconds) to wait for the API when fetching them or
+# sending scans
+api_timeout_seconds: 5""".format(chores_lib.api_url, default_scan_queue_path)
 
   if arguments['--config-skeleton']:
     print default_config_skeleton
     exit(0)
 
+  if arguments['--fetch-assets']:
+    for path in static_assets.fetch_vendored(os.path.join(html_root, 'static')):
+      print("Fetched {0}".format(path))
+    assets.build()
+    for filename in assets.prune_cache():
+      print("Removed stale {0}".format(filename))
+    exit(0)
+
   default_config_filename = os.path.join(os.path.expanduser("~"),
       ".config", "chores_website_serverrc.yaml")
 
@@ -430,10 +698,31 @@ debug_mode: True"""
 
   # Fetch variables from config file (or create one if none
   # exists yet)
-  conf_vars = config_file_variables(config_filename,
-      default_config_skeleton)
+  with chores_lib.timed('read config'):
+    conf_vars = config_file_variables(config_filename,
+        default_config_skeleton)
+
+  # Where the database is served from
+  chores_lib.api_url = conf_vars.get('api_url', chores_lib.api_url)
+
+  # Send scans to the API in the background
+  global scans
+  with chores_lib.timed('open scan queue'):
+    scans = scan_queue.scan_queue(
+        conf_vars.get('scan_queue_path', default_scan_queue_path),
+        api_url=chores_lib.api_url)
+    scan_queue.scan_queue_worker(scans, send_scan).start()
+  catalog.ttl = conf_vars.get('catalog_ttl_seconds', catalog.ttl)
+  catalog.timeout = conf_vars.get('api_timeout_seconds', catalog.timeout)
+  catalog.refresh_in_background()
+
+  # Only compresses what --fetch-assets or an earlier start hasn't
+  with chores_lib.timed('load static assets'):
+    assets.build()
+
+  if arguments['--profile-startup']:
+    print chores_lib.startup_report()
 
-  # Database
   bottle.run(host=conf_vars['host_name'],
       port=conf_vars['port'], debug=conf_vars['debug_mode'])
 
@@ -0,0 +1,141 @@
+"""Durable local queue of scanned done chores
+
+Scans are written to a small SQLite file and acknowledged right
+away.  A background worker sends them on to the API, retrying for as
+long as the API is slow or down, and only forgets a scan once the API
+has answered for it.
+"""
+
+import datetime
+import sqlite3
+import threading
+import time
+import traceback
+
+datetime_format = "%Y-%m-%d %H:%M:%S.%f"
+
+class scan_queue():
+  """Done chores waiting to be sent to the API at `api_url`, kept in
+  `path`
+
+  Several web servers (one per household, say) may share `path`.
+  Each queued scan records the API it's for, and a queue only ever
+  hands out its own.
+  """
+  def __init__(self, path, api_url=None):
+    self.path = path
+    self.api_url = api_url
+    self.lock = threading.Lock()
+    self.added = threading.Event()
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    # Write-ahead logging makes each put() a single append and sync
+    self.connection.execute("PRAGMA journal_mode=WAL;")
+    self.connection.execute("""
+      CREATE TABLE IF NOT EXISTS pending_scans (
+        rowid INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+        chore_id INTEGER NOT NULL, datetime TEXT NOT NULL, api_url TEXT);
+    """)
+    columns = [row[1] for row in self.connection.execute(
+        "PRAGMA table_info(pending_scans);")]
+    if 'api_url' not in columns:
+      self.connection.execute("ALTER TABLE pending_scans ADD COLUMN api_url TEXT;")
+    # Scans queued before they recorded their API were for whichever
+    # one served this file then, most likely this one
+    self.connection.execute(
+        "UPDATE pending_scans SET api_url = ? WHERE api_url IS NULL;",
+        (api_url,))
+    self.connection.commit()
+
+  def put(self, user_id, chore_id, dt):
+    """Durably queue `user_id` having done `chore_id` at `dt`"""
+    with self.lock:
+      self.connection.execute(
+          "INSERT INTO pending_scans (user_id, chore_id, datetime, api_url) VALUES (?, ?, ?, ?);",
+          (int(user_id), int(chore_id), dt.strftime(datetime_format),
+              self.api_url))
+      self.connection.commit()
+    self.added.set()
+
+  def pending(self, limit=100):
+    """Return up to `limit` of the oldest queued scans
+
+      [(rowid, user_id, chore_id, datetime), ...]
+    """
+    with self.lock:
+      rows = self.connection.execute(
+          "SELECT rowid, user_id, chore_id, datetime FROM pending_scans WHERE api_url IS ? ORDER BY rowid LIMIT ?;",
+          (self.api_url, limit)).fetchall()
+    return [
+      (rowid, user_id, chore_id, datetime.datetime.strptime(dt, datetime_format))
+      for rowid, user_id, chore_id, dt in rows
+    ]
+
+  def remove(self, rowid):
+    with self.lock:
+      self.connection.execute("DELETE FROM pending_scans WHERE rowid = ?;",
+          (rowid,))
+      self.connection.commit()
+
+  def __len__(self):
+    with self.lock:
+      return self.connection.execute(
+          "SELECT count(*) FROM pending_scans WHERE api_url IS ?;",
+          (self.api_url,)).fetchone()[0]
+
+
+class scan_queue_worker(threading.Thread):
+  """Background thread sending scans from `queue` with `send`
+
+  `send(user_id, chore_id, dt)` returns the API's HTTP status code
+  and raises IOError (as requests does) if it couldn't be reached.
+  """
+  def __init__(self, queue, send, max_backoff=60):
+    threading.Thread.__init__(self, name='scan_queue_worker')
+    self.daemon = True
+    self.queue = queue
+    self.send = send
+    self.max_backoff = max_backoff
+    self.stopped = threading.Event()
+
+  def flush(self):
+    """Send queued scans until the queue is empty or the API fails
+
+    Returns True if the queue was emptied.
+    """
+    while True:
+      scans = self.queue.pending()
+      if not scans:
+        return True
+      for rowid, user_id, chore_id, dt in scans:
+        try:
+          status = self.send(user_id, chore_id, dt)
+        except (IOError, ValueError):
+          return False
+        if status >= 500:
+          return False
+        if status >= 400:
+          # Retrying won't help, so don't hold up the rest of the queue
+          print("Dropping scan of chore {0} by user {1} at {2}: API said {3}".format(
+              chore_id, user_id, dt, status))
+        self.queue.remove(rowid)
+
+  def run(self):
+    backoff = 1
+    while not self.stopped.is_set():
+      self.queue.added.clear()
+      try:
+        emptied = self.flush()
+      except Exception:
+        traceback.print_exc()
+        emptied = False
+      if emptied:
+        backoff = 1
+        # Sleep until something is queued
+        self.queue.added.wait(self.max_backoff)
+      else:
+        time.sleep(backoff)
+        backoff = min(backoff * 2, self.max_backoff)
+
+  def stop(self):
+    self.stopped.set()
+    self.queue.added.set()
@@ -0,0 +1,249 @@
+"""Static files served under content-hashed URLs
+
+Every file under the static directories is read and hashed when the
+server starts.  Gzip and brotli variants are made once per content
+and kept on disk by hash (see asset_bundle), so later starts only load
+them.  Pages refer to them as /assets/<hash>/<path>, so browsers can
+keep them forever: a changed file gets a new URL.  Third-party libraries the page used to load
+from CDNs are kept under static/vendor (see fetch_vendored()) so the
+page also works when the internet doesn't.
+"""
+
+import collections
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import posixpath
+import re
+import urlparse
+
+from chores_lib import chores_lib
+
+try:
+  import brotli
+except ImportError:
+  # Only gzip then
+  brotli = None
+
+# Where each vendored library lives under static/ and where it came from
+vendored = collections.OrderedDict([
+  ('vendor/jquery-1.8.2/jquery-1.8.2.min.js',
+      'http://code.jquery.com/jquery-1.8.2.min.js'),
+  ('vendor/jquery.mobile-1.2.0/jquery.mobile-1.2.0.min.js',
+      'http://code.jquery.com/mobile/1.2.0/jquery.mobile-1.2.0.min.js'),
+  ('vendor/jquery.mobile-1.2.0/jquery.mobile-1.2.0.min.css',
+      'http://code.jquery.com/mobile/1.2.0/jquery.mobile-1.2.0.min.css'),
+  ('vendor/font-awesome-4.3.0/css/font-awesome.min.css',
+      'https://maxcdn.bootstrapcdn.com/font-awesome/4.3.0/css/font-awesome.min.css'),
+])
+
+# Not worth compressing again
+compressed_extensions = ('.gif', '.png', '.jpg', '.jpeg', '.woff', '.woff2')
+
+# url(...) in CSS, with optional quotes and ?query or #fragment
+css_url_pattern = re.compile(
+    r'''url\(\s*(['"]?)([^'"()?#]+)([?#][^'"()]*)?\1\s*\)''')
+
+def relative_css_urls(css):
+  """Return the relative paths `css` refers to with url(...)"""
+  return [
+    match.group(2) for match in css_url_pattern.finditer(css)
+    if not re.match(r'^([a-z]+:|/)', match.group(2))
+  ]
+
+asset = collections.namedtuple('asset',
+    ['path', 'digest', 'content_type', 'encodings'])
+
+class asset_bundle():
+  """Every file under `roots`, {prefix: directory}, as assets
+
+  A file at <directory>/x/y.css is asset <prefix>x/y.css.  CSS url()s
+  pointing at other assets are rewritten to those assets' hashed
+  URLs, so fonts and images are cached forever too.
+
+  Compressed variants are kept in `cache_dir`, if given, as
+  <sha1 of content>.gz and .br.
+  """
+  def __init__(self, roots, cache_dir=None):
+    self.roots = roots
+    self.cache_dir = cache_dir
+    self.assets = None
+
+  def build(self):
+    files = {}
+    for prefix, directory in sorted(self.roots.items()):
+      for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+          full_path = os.path.join(dirpath, filename)
+          path = prefix + os.path.relpath(full_path, directory).replace(os.sep, '/')
+          with open(full_path, 'rb') as f:
+            files[path] = f.read()
+
+    assets = {}
+    # Everything else first, so CSS can refer to their hashed URLs
+    for path in sorted(files, key=lambda path: path.endswith('.css')):
+      content = files[path]
+      if path.endswith('.css'):
+        content = self.rewrite_css(path, content, assets)
+      assets[path] = make_asset(path, content, self.cache_dir)
+    self.assets = assets
+
+  def prune_cache(self):
+    """Remove compressed variants of content no asset has any more,
+    returning their file names
+    """
+    if self.assets is None:
+      self.build()
+    if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+      return []
+    current = set(hashlib.sha1(found.encodings['identity']).hexdigest()
+        for found in self.assets.values())
+    removed = []
+    for filename in sorted(os.listdir(self.cache_dir)):
+      if os.path.splitext(filename)[0] not in current:
+        os.remove(os.path.join(self.cache_dir, filename))
+        removed.append(filename)
+    return removed
+
+  def rewrite_css(self, path, css, assets):
+    def hashed(match):
+      quote, target, suffix = match.groups()
+      target_path = posixpath.normpath(
+          posixpath.join(posixpath.dirname(path), target))
+      if target_path not in assets:
+        return match.group(0)
+      return 'url({0}{1}{2}{0})'.format(quote,
+          hashed_url(assets[target_path]), suffix or '')
+    return css_url_pattern.sub(hashed, css)
+
+  def get(self, path):
+    """Return the asset at `path`, or None"""
+    if self.assets is None:
+      self.build()
+    return self.assets.get(path)
+
+  def url(self, path):
+    """Return the hashed URL of `path`, or where it's vendored from
+    if it hasn't been fetched
+    """
+    found = self.get(path)
+    if found is None:
+      return vendored[path]
+    return hashed_url(found)
+
+def hashed_url(found):
+  return '/assets/{0}/{1}'.format(found.digest, found.path)
+
+def gzipped(content):
+  buffer = io.BytesIO()
+  # mtime=0 so the same content always compresses the same
+  with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+    f.write(content)
+  return buffer.getvalue()
+
+# Encoding: (cache file extension, compressor or None if unavailable)
+compressors = collections.OrderedDict([
+  ('gzip', ('.gz', gzipped)),
+  ('br', ('.br', brotli.compress if brotli is not None else None)),
+])
+
+def make_asset(path, content, cache_dir=None):
+  """Return an asset of `content`, with gzip and brotli variants if
+  they're smaller
+
+  Variants are read from `cache_dir` if they're there, and written
+  there if they weren't.
+  """
+  sha1 = hashlib.sha1(content).hexdigest()
+  encodings = {'identity': content}
+  if not path.endswith(compressed_extensions):
+    for encoding, (extension, compress) in compressors.items():
+      variant = cached_variant(cache_dir, sha1 + extension, content, compress)
+      if variant is not None and len(variant) < len(content):
+        encodings[encoding] = variant
+  content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+  if content_type.startswith('text/') or content_type == 'application/javascript':
+    content_type += '; charset=UTF-8'
+  return asset(path, sha1[:12], content_type, encodings)
+
+def cached_variant(cache_dir, filename, content, compress):
+  """Return `content` compressed, from `cache_dir`/`filename` or by
+  `compress` (saving it there), or None if neither can
+  """
+  cache_path = os.path.join(cache_dir, filename) if cache_dir else None
+  if cache_path is not None and os.path.exists(cache_path):
+    with open(cache_path, 'rb') as f:
+      return f.read()
+  if compress is None:
+    return None
+  variant = compress(content)
+  if cache_path is not None:
+    try:
+      if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+      # Renamed into place so a half written file is never read
+      partial_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+      with open(partial_path, 'wb') as f:
+        f.write(variant)
+      os.rename(partial_path, cache_path)
+    except (IOError, OSError):
+      # Read-only, say.  Compressed again next time.
+      pass
+  return variant
+
+def accepted_encodings(accept_encoding):
+  """Return the encodings an Accept-Encoding header allows"""
+  accepted = set(['identity'])
+  for item in (accept_encoding or '').split(','):
+    name, _, parameters = item.strip().partition(';')
+    quality = parameters.strip()
+    if quality.startswith('q='):
+      try:
+        if float(quality[2:]) == 0:
+          continue
+      except ValueError:
+        continue
+    if name:
+      accepted.add(name.strip().lower())
+  return accepted
+
+def choose_encoding(found, accept_encoding):
+  """Return (encoding, body) of the smallest variant of `found` that
+  `accept_encoding` allows
+  """
+  accepted = accepted_encodings(accept_encoding)
+  for encoding in ('br', 'gzip'):
+    if encoding in found.encodings and encoding in accepted:
+      return encoding, found.encodings[encoding]
+  return 'identity', found.encodings['identity']
+
+def fetch_vendored(static_root):
+  """Download vendored libraries missing from `static_root`, and the
+  fonts and images their CSS refers to
+
+  Returns the paths downloaded.
+  """
+  to_fetch = list(vendored.items())
+  fetched = []
+  while to_fetch:
+    path, url = to_fetch.pop(0)
+    local_path = os.path.join(static_root, *path.split('/'))
+    if not os.path.exists(local_path):
+      response = chores_lib.requests.get(url)
+      response.raise_for_status()
+      local_dir = os.path.dirname(local_path)
+      if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+      with open(local_path, 'wb') as f:
+        f.write(response.content)
+      fetched.append(path)
+    if path.endswith('.css'):
+      with open(local_path, 'rb') as f:
+        css = f.read()
+      for target in relative_css_urls(css):
+        target_path = posixpath.normpath(
+            posixpath.join(posixpath.dirname(path), target))
+        to_fetch.append((target_path, urlparse.urljoin(url, target)))
+  return fetched
@@ -0,0 +1,174 @@
+"""Fixtures shared by the tests
+
+Databases are built from scratch with the same schema as
+`default_chores.sql` and the web client's HTTP calls are routed
+in-process to the API app so both SQL statements and HTTP calls
+can be counted.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+import pytest
+import sqlalchemy
+
+from chores_api import chores_api
+from chores_controller import chores_controller
+from chores_lib import chores_lib
+
+schema = """
+  CREATE TABLE "chores" (name text not null, worth integer not null);
+  CREATE TABLE "done_chores" (user_id INT NOT NULL, chore_id TEXT NOT NULL, datetime TEXT, FOREIGN KEY(user_id) REFERENCES users(rowid), FOREIGN KEY(chore_id) REFERENCES chores(rowid));
+  CREATE TABLE "users" (name TEXT);
+"""
+
+# A Monday, so that the default 'Friday' rollover splits the
+# generated history across two weeks
+fixture_now = datetime.datetime(2015, 9, 7, 22, 0, 0)
+# The household settings' defaults
+rollover_day = 'Friday'
+rollover_time = datetime.time(6, 0)
+
+
+def build_database(path, n_users, n_chores, done_per_user):
+  """Create a chores database at `path` with the given sizes"""
+  connection = sqlite3.connect(path)
+  connection.executescript(schema)
+  for i in range(n_users):
+    connection.execute("INSERT INTO users (name) VALUES (?)",
+        ('user{0}'.format(i),))
+  for i in range(n_chores):
+    connection.execute("INSERT INTO chores (name, worth) VALUES (?, ?)",
+        ('chore{0}'.format(i), i + 1))
+  for user_id in range(1, n_users + 1):
+    for i in range(done_per_user):
+      dt = fixture_now - datetime.timedelta(hours=7 * i + user_id)
+      connection.execute(
+          "INSERT INTO done_chores (user_id, chore_id, datetime) VALUES (?, ?, ?)",
+          (user_id, str(i % n_chores + 1), chores_lib.datetime_to_string(dt)))
+  connection.commit()
+  connection.close()
+
+
+class statement_counter(object):
+  """Counts SQL statements executed through `engine`"""
+  def __init__(self, engine):
+    self.count = 0
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', self._count)
+
+  def _count(self, *args):
+    self.count += 1
+
+
+def wsgi_request(app, method, url, body=b'', headers=None):
+  """Call `app` directly with `method` on `url`
+
+  Returns (status code, response body)
+  """
+  status, _, response = wsgi_response(app, method, url, body, headers)
+  return status, response
+
+
+def wsgi_response(app, method, url, body=b'', headers=None):
+  """Like wsgi_request(), but returns (status code, response headers, response body)"""
+  path, _, query = url.partition('?')
+  if '://' in path:
+    path = '/' + path.split('://', 1)[1].partition('/')[2]
+  environ = {}
+  setup_testing_defaults(environ)
+  environ['REQUEST_METHOD'] = method
+  environ['PATH_INFO'] = path
+  environ['QUERY_STRING'] = query
+  environ['CONTENT_LENGTH'] = str(len(body))
+  environ['wsgi.input'] = BytesIO(body)
+  for name, value in (headers or {}).items():
+    environ['HTTP_' + name.upper().replace('-', '_')] = value
+  status = []
+  response_headers = {}
+  def start_response(status_line, headers, exc_info=None):
+    status.append(int(status_line.split()[0]))
+    response_headers.update(headers)
+  response = b''.join(app(environ, start_response))
+  return status[0], response_headers, response
+
+
+class fake_response(object):
+  def __init__(self, status_code, content):
+    self.status_code = status_code
+    self.content = content
+
+  def json(self):
+    return json.loads(self.content)
+
+  def raise_for_status(self):
+    if self.status_code >= 400:
+      raise RuntimeError('HTTP {0}'.format(self.status_code))
+
+
+class in_process_requests(object):
+  """Stands in for the `requests` module, routing calls to `app`"""
+  def __init__(self, app):
+    self.app = app
+    self.count = 0
+
+  def _call(self, method, url, data=None, headers=None, **kwargs):
+    self.count += 1
+    body = (data or '').encode('utf-8') if not isinstance(data, bytes) else data
+    return fake_response(*wsgi_request(self.app, method, url, body, headers))
+
+  def get(self, url, **kwargs):
+    return self._call('GET', url, **kwargs)
+
+  def put(self, url, **kwargs):
+    return self._call('PUT', url, **kwargs)
+
+  def patch(self, url, **kwargs):
+    return self._call('PATCH', url, **kwargs)
+
+  def delete(self, url, **kwargs):
+    return self._call('DELETE', url, **kwargs)
+
+
+class household(object):
+  """A fixture database with a controller, an API app and counters"""
+  def __init__(self, path):
+    self.path = path
+    self.pool = chores_api.household_pool(
+        {'default': {'path_to_database': path}}, default='default')
+    self.controller = self.pool.controller('default')
+    self.statements = statement_counter(self.controller.session.bind)
+    self.app = chores_api.chores_app(self.pool)
+    self.http = in_process_requests(self.app)
+
+
+@pytest.fixture
+def make_controller(tmpdir):
+  """Factory building fixture databases of a given size, returning a
+  chores_controller of each, opened with `kwargs`
+  """
+  def make(n_users, n_chores, done_per_user, **kwargs):
+    path = str(tmpdir.join('chores_{0}_{1}_{2}.sql'.format(
+        n_users, n_chores, done_per_user)))
+    build_database(path, n_users, n_chores, done_per_user)
+    return chores_controller.chores_controller(path, **kwargs)
+  return make
+
+
+@pytest.fixture
+def make_household(tmpdir, monkeypatch):
+  """Factory building households of a given size with the web
+  client's HTTP calls routed to their API app
+  """
+  def make(n_users, n_chores, done_per_user):
+    path = str(tmpdir.join('chores_{0}_{1}_{2}.sql'.format(
+        n_users, n_chores, done_per_user)))
+    build_database(path, n_users, n_chores, done_per_user)
+    made = household(path)
+    monkeypatch.setattr(chores_lib, 'requests', made.http)
+    return made
+  return make
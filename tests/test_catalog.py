@@ -0,0 +1,77 @@
+"""The controller's in-memory catalog of chores and users"""
+
+import sqlite3
+
+from chores_api import chores_api
+from tests.conftest import fixture_now, rollover_day, rollover_time, statement_counter
+
+
+def test_lookups_dont_touch_the_database(make_controller):
+  controller = make_controller(3, 4, 20)
+  statements = statement_counter(controller.session.bind)
+  assert controller.chore_name(2) == 'chore1'
+  assert controller.chore_name(u'2') == 'chore1'
+  assert controller.user_name(1) == 'user0'
+  assert controller.rowid('chore1', 'chore') == 2
+  assert controller.rowid('user2', 'user') == 3
+  assert [x['worth'] for x in controller.chores()] == [4, 3, 2, 1]
+  assert statements.count == 0
+
+
+def test_changes_update_the_catalog(make_controller):
+  controller = make_controller(3, 4, 20)
+  controller.new_chore('sweeping', 5)
+  controller.new_user('newbie')
+  sweeping = controller.rowid('sweeping', 'chore')
+  assert controller.chores()[0] == {'rowid': sweeping, 'name': 'sweeping',
+      'worth': 5}
+  controller.change_chore(sweeping, worth=1, name='mopping')
+  assert controller.chore_name(sweeping) == 'mopping'
+  controller.delete_chore(controller.rowid('chore0', 'chore'))
+  controller.delete_user(controller.rowid('newbie', 'user'))
+  # A fresh catalog read from the database agrees
+  expected = (controller.chores(), sorted(controller.catalog.users.items()))
+  controller.reload_catalog()
+  assert (controller.chores(), sorted(controller.catalog.users.items())) == expected
+
+
+def test_scores_use_catalog_worths(make_controller):
+  controller = make_controller(3, 4, 20)
+  before = controller.weekly_scores(fixture_now, rollover_day, rollover_time)
+  user_id = before[0]['rowid']
+  chore_id = controller.rowid('chore3', 'chore')
+  controller.new_done_chore(user_id, chore_id, fixture_now)
+  after = controller.weekly_scores(fixture_now, rollover_day, rollover_time)
+  assert after[0]['week_score'] == before[0]['week_score'] + 4
+  assert controller.weekly_score(user_id, fixture_now, rollover_day,
+      rollover_time) == after[0]['week_score']
+  # Deleted chores no longer score
+  total = controller.users()
+  controller.delete_chore(chore_id)
+  assert sum(x['score'] for x in controller.users()) < sum(
+      x['score'] for x in total)
+
+
+def test_changing_an_unknown_chore_does_nothing(make_controller):
+  controller = make_controller(3, 4, 20)
+  before = controller.chores()
+  controller.change_chore(99, worth=3)
+  assert controller.chores() == before
+  # Nothing left half done
+  controller.new_chore('sweeping', 5)
+  controller.reload_catalog()
+  assert len(controller.chores()) == len(before) + 1
+
+
+def test_rollover_rereads_serving_catalogs(make_household):
+  made = make_household(3, 4, 2)
+  connection = sqlite3.connect(made.path)
+  connection.execute("INSERT INTO chores (name, worth) VALUES ('by hand', 9);")
+  connection.commit()
+  connection.close()
+  assert 'by hand' not in [x['name'] for x in made.controller.chores()]
+  scheduler = chores_api.rollover_scheduler(made.pool.households,
+      serving_pool=made.pool)
+  scheduler.run_once(fixture_now)
+  chores = made.pool.controller('default').chores()
+  assert chores[0]['name'] == 'by hand'
@@ -0,0 +1,87 @@
+"""The change log, GET /changes and chores_lib.mirror"""
+
+import datetime
+import sqlite3
+
+from chores_controller import chores_controller
+from chores_lib import chores_lib
+from tests.conftest import fixture_now, wsgi_request
+
+
+def same_as_api(made, mirror):
+  controller = made.controller
+  assert mirror.chores() == controller.chores()
+  assert [(x['rowid'], x['name']) for x in mirror.users()] == sorted(
+      controller.catalog.users.items())
+  assert [(x['rowid'], x['user_id'], x['chore_id'], x['datetime'])
+      for x in mirror.done_chores()] == [
+      (x['rowid'], x['user_id'], x['chore_id'], x['datetime'])
+      for x in controller.done_chores()]
+
+
+def test_existing_rows_are_logged_once(make_controller):
+  controller = make_controller(3, 4, 5)
+  everything = controller.changes()
+  assert len(everything['changes']) == 3 + 4 + 3 * 5
+  controller.close()
+  # Opening it again doesn't log them again
+  controller = chores_controller.chores_controller(
+      controller.session.bind.url.database)
+  assert controller.changes() == everything
+
+
+def test_changes_are_compacted(make_controller):
+  controller = make_controller(3, 4, 5)
+  since = controller.changes()['version']
+  controller.new_chore('sweeping', 5)
+  sweeping = controller.rowid('sweeping', 'chore')
+  controller.change_chore(sweeping, worth=8)
+  controller.change_chore(sweeping, name='mopping')
+  controller.delete_user(1)
+  received = controller.changes(since)
+  assert received['version'] == since + 4
+  assert [(x['table'], x['rowid'], x['op'], x['row']) for x in received['changes']] == [
+    ('chores', sweeping, 'put', {'rowid': sweeping, 'name': 'mopping', 'worth': 8}),
+    ('users', 1, 'delete', None),
+  ]
+  assert controller.changes(received['version'])['changes'] == []
+
+
+def test_mirror_follows_the_api(make_household):
+  made = make_household(4, 5, 20)
+  mirror = chores_lib.mirror()
+  made.http.count = 0
+  assert mirror.sync() == 4 + 5 + 4 * 20
+  same_as_api(made, mirror)
+
+  chores_lib.new_chore('sweeping', '5')
+  chores_lib.new_done_chore(2, 3, fixture_now)
+  chores_lib.delete_done_chore('1')
+  made.controller.compact_history(fixture_now, 'Friday', datetime.time(6, 0))
+  assert mirror.sync() > 0
+  same_as_api(made, mirror)
+  assert mirror.sync() == 0
+  # Three syncs and three changes
+  assert made.http.count == 6
+
+
+def test_bad_worths_write_nothing(make_household):
+  made = make_household(2, 3, 2)
+  before = made.controller.changes()
+  assert wsgi_request(made.app, 'PUT', '/chores/junk/abc')[0] == 400
+  assert wsgi_request(made.app, 'PATCH', '/chores/1', b'{"worth": "lots"}')[0] == 400
+  assert wsgi_request(made.app, 'PATCH', '/chores/1', b'{"worth": 2.5}')[0] == 400
+  # Nothing left open to lock out other connections
+  other = sqlite3.connect(made.path, timeout=0)
+  other.execute("INSERT INTO users (name) VALUES ('elsewhere')")
+  other.commit()
+  other.close()
+  # ...or to be committed, unlogged, by the next write
+  made.controller.new_user('newbie')
+  assert 'junk' not in made.controller.catalog.chore_rowids
+  assert made.controller.catalog.chores[1].worth == 1
+  made.controller.reload_catalog()
+  assert 'junk' not in made.controller.catalog.chore_rowids
+  assert made.controller.catalog.chores[1].worth == 1
+  assert [x['row'] for x in made.controller.changes(before['version'])['changes']] \
+      == [{'rowid': made.controller.rowid('newbie', 'user'), 'name': 'newbie'}]
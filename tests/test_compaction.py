@@ -0,0 +1,61 @@
+"""Compacting old done chores into weekly rollups"""
+
+import datetime
+import gzip
+import json
+
+from chores_api import chores_api
+from tests.conftest import build_database, fixture_now, rollover_day, rollover_time
+
+
+def scores(controller):
+  """Everything that's scored, for each of the fixture's weeks"""
+  weeks = [fixture_now - datetime.timedelta(days=3 * i) for i in range(15)]
+  return [
+    (
+      controller.weekly_scores(week, rollover_day, rollover_time),
+      controller.winner(week, rollover_day, rollover_time),
+      [controller.weekly_score(user_id, week, rollover_day, rollover_time)
+          for user_id in (1, 2, 3)],
+    )
+    for week in weeks
+  ], controller.users()
+
+
+def test_scores_unchanged_by_compaction(make_controller, tmpdir):
+  controller = make_controller(3, 4, 100)
+  before = scores(controller)
+  export_path = str(tmpdir.join('archive.jsonl.gz'))
+  compacted = controller.compact_history(
+      fixture_now - datetime.timedelta(weeks=2), rollover_day, rollover_time,
+      export_path=export_path)
+  assert compacted['archived'] > 0
+  assert scores(controller) == before
+  remaining = controller.done_chores()
+  assert len(remaining) == 300 - compacted['archived']
+  assert min(x['datetime'] for x in remaining) >= compacted['cutoff']
+  with gzip.open(export_path) as export_file:
+    exported = [json.loads(line) for line in export_file]
+  assert len(exported) == compacted['archived']
+
+
+def test_compacting_again_merges_into_existing_rollups(make_controller):
+  controller = make_controller(3, 4, 100)
+  before = scores(controller)
+  for weeks_ago in (3, 3, 1):
+    controller.compact_history(fixture_now - datetime.timedelta(weeks=weeks_ago),
+        rollover_day, rollover_time)
+  assert scores(controller) == before
+
+
+def test_compact_household_uses_its_settings(tmpdir):
+  path = str(tmpdir.join('chores.sql'))
+  build_database(path, 3, 4, 100)
+  archive_dir = str(tmpdir.join('archive'))
+  pool = chores_api.household_pool({'smiths': {'path_to_database': path,
+      'keep_weeks': 1, 'archive_dir': archive_dir}})
+  compacted = chores_api.compact_household(pool, 'smiths', fixture_now)
+  assert compacted['archived'] > 0
+  assert tmpdir.join('archive', 'smiths-done_chores.jsonl.gz').check()
+  pool.households['smiths'].pop('keep_weeks')
+  assert chores_api.compact_household(pool, 'smiths', fixture_now) is None
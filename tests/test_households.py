@@ -0,0 +1,86 @@
+"""Household selection and the pool of open databases"""
+
+import json
+import threading
+
+from chores_api import chores_api
+from chores_controller import chores_controller
+from tests.conftest import build_database, fixture_now, wsgi_request
+
+
+def make_pool(tmpdir, max_open=8):
+  households = {}
+  for name, n_users in (('smiths', 2), ('joneses', 3)):
+    path = str(tmpdir.join(name + '.sql'))
+    build_database(path, n_users, 2, 1)
+    households[name] = {'path_to_database': path}
+  households['joneses']['rollover_day'] = 'Sunday'
+  return chores_api.household_pool(households, default='smiths',
+      max_open=max_open)
+
+
+def get_json(app, url, **environ):
+  status, body = wsgi_request(app, 'GET', url, **environ)
+  assert status == 200
+  return json.loads(body)
+
+
+def test_household_chosen_by_prefix_header_or_default(tmpdir):
+  app = chores_api.chores_app(make_pool(tmpdir))
+  assert len(get_json(app, '/households/joneses/users')['users']) == 3
+  assert len(get_json(app, '/users',
+      headers={'X-Chores-Household': 'joneses'})['users']) == 3
+  assert len(get_json(app, '/users')['users']) == 2
+
+
+def test_unknown_household_is_not_found(tmpdir):
+  app = chores_api.chores_app(make_pool(tmpdir))
+  status, _ = wsgi_request(app, 'GET', '/households/nobody/users')
+  assert status == 404
+
+
+def test_settings_per_household(tmpdir):
+  app = chores_api.chores_app(make_pool(tmpdir))
+  settings = get_json(app, '/households/joneses/settings')['settings']
+  assert settings['rollover_day'] == 'Sunday'
+  assert settings['rollover_time'] == chores_api.default_rollover_time
+  settings = get_json(app, '/settings')['settings']
+  assert settings['household'] == 'smiths'
+  assert settings['rollover_day'] == chores_api.default_rollover_day
+
+
+def test_pool_opens_lazily_and_evicts_least_recently_used(tmpdir):
+  pool = make_pool(tmpdir, max_open=1)
+  assert len(pool.open_controllers) == 0
+  smiths = pool.controller('smiths')
+  assert pool.controller('smiths') is smiths
+  pool.controller('joneses')
+  assert list(pool.open_controllers) == ['joneses']
+  assert len(pool.controller('smiths').users()) == 2
+
+
+def test_each_database_is_migrated_once(tmpdir, monkeypatch):
+  migrations = []
+  migrate = chores_controller.chores_controller.migrate
+  def counting_migrate(controller):
+    migrations.append(controller)
+    migrate(controller)
+  monkeypatch.setattr(chores_controller.chores_controller, 'migrate',
+      counting_migrate)
+  pool = make_pool(tmpdir)
+  scheduler = chores_api.rollover_scheduler(pool.households)
+  def first_request():
+    # Controllers stay on the thread that opened them
+    requests_pool = chores_api.household_pool(pool.households)
+    requests_pool.controller('smiths').close()
+  threads = [
+    threading.Thread(target=scheduler.run_once, args=(fixture_now,)),
+    threading.Thread(target=first_request),
+  ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  pool.controller('joneses')
+  assert len(migrations) == 2
+  assert pool.controller('smiths').changes()['changes']
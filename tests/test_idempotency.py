@@ -0,0 +1,107 @@
+"""Done chores are recorded once however often they're sent"""
+
+import datetime
+import json
+
+from chores_controller import chores_controller
+from chores_lib import chores_lib
+from tests.conftest import fixture_now, wsgi_request
+
+later = fixture_now + datetime.timedelta(hours=1)
+
+
+def count(controller):
+  return len(controller.done_chores())
+
+
+def test_repeats_within_the_window_count_once(make_controller):
+  controller = make_controller(3, 4, 2)
+  before = count(controller)
+  assert controller.new_done_chore(1, 2, later)
+  assert not controller.new_done_chore(1, 2, later + datetime.timedelta(seconds=1))
+  assert controller.new_done_chore(2, 2, later)
+  assert controller.new_done_chore(1, 2, later + datetime.timedelta(minutes=5))
+  assert count(controller) == before + 3
+
+
+def test_double_taps_across_a_window_edge_count_once(make_controller):
+  controller = make_controller(3, 4, 2)
+  before = count(controller)
+  edge = datetime.datetime(2015, 9, 7, 22, 1)
+  tap = datetime.timedelta(milliseconds=200)
+  assert controller.new_done_chore(1, 2, edge - tap)
+  assert not controller.new_done_chore(1, 2, edge + tap)
+  # In either order
+  assert controller.new_done_chore(2, 2, edge + tap)
+  assert not controller.new_done_chore(2, 2, edge - tap)
+  # And once the controller has forgotten the keys
+  assert controller.new_done_chore(3, 2, edge - tap)
+  controller.recent_keys.clear()
+  assert not controller.new_done_chore(3, 2, edge + tap)
+  assert count(controller) == before + 3
+  # Two windows along is a different time
+  assert controller.new_done_chore(1, 2, edge + datetime.timedelta(minutes=2))
+
+
+def test_keys_survive_restarts(make_controller):
+  controller = make_controller(3, 4, 2)
+  assert controller.new_done_chore(1, 2, later, idempotency_key='scan-1')
+  before = count(controller)
+  controller.close()
+  # The new controller hasn't seen the key, so the unique index stops it
+  controller = chores_controller.chores_controller(controller.session.bind.url.database)
+  assert not controller.new_done_chore(1, 2, later + datetime.timedelta(hours=1),
+      idempotency_key='scan-1')
+  assert count(controller) == before
+  assert 'scan-1' in controller.recent_keys
+
+
+def test_deleted_done_chores_can_be_done_again(make_controller):
+  controller = make_controller(3, 4, 2)
+  controller.new_done_chore(1, 2, later)
+  rowid = controller.done_chores(user_id=1, reverse=True)[0]['rowid']
+  controller.delete_done_chore(rowid)
+  assert controller.new_done_chore(1, 2, later)
+
+
+def test_keys_stay_out_of_done_chores(make_controller):
+  controller = make_controller(3, 4, 2)
+  controller.new_done_chore(1, 2, later, idempotency_key='scan-1')
+  for done_chore in controller.done_chores():
+    assert sorted(done_chore) == ['chore_id', 'datetime', 'rowid', 'user_id']
+
+
+def test_zero_window_turns_deduping_off(make_controller):
+  controller = make_controller(3, 4, 2, dedupe_window_seconds=0)
+  before = count(controller)
+  assert controller.new_done_chore(1, 2, later)
+  assert controller.new_done_chore(1, 2, later)
+  assert count(controller) == before + 2
+
+
+def test_recent_keys_are_bounded(make_controller):
+  controller = make_controller(3, 4, 2, recent_keys_size=3)
+  for i in range(5):
+    controller.new_done_chore(1, 2, later, idempotency_key=str(i))
+  assert list(controller.recent_keys) == ['2', '3', '4']
+
+
+def test_retried_requests_are_cheap(make_household):
+  made = make_household(3, 4, 2)
+  url = '/done_chores/1/2/' + chores_lib.datetime_to_string(later)
+  status, body = wsgi_request(made.app, 'PUT', url)
+  assert json.loads(body) == {'recorded': True}
+  before = made.statements.count
+  status, body = wsgi_request(made.app, 'PUT', url)
+  assert status == 200
+  assert json.loads(body) == {'recorded': False}
+  assert made.statements.count == before
+
+
+def test_client_keys(make_household):
+  made = make_household(3, 4, 2)
+  before = count(made.controller)
+  for minutes in (0, 10):
+    chores_lib.new_done_chore(1, 2, later + datetime.timedelta(minutes=minutes),
+        idempotency_key='form-7')
+  assert count(made.controller) == before + 1
@@ -0,0 +1,132 @@
+"""Query budgets for page renders and API routes
+
+Each route and the complete web page are exercised against
+households of growing size.  The number of SQL statements and HTTP
+calls must stay under a fixed budget regardless of size, so
+reintroducing a per-user or per-row query fails the build.
+"""
+
+import datetime
+
+import pytest
+
+from chores_lib import chores_lib
+from clients.web import chores_webpage_server
+from tests.conftest import fixture_now, wsgi_request
+
+sizes = [(2, 3, 2), (8, 6, 10), (30, 12, 40)]
+
+now = chores_lib.datetime_to_string(fixture_now)
+
+# (method, url, maximum SQL statements)
+api_budgets = [
+  ('GET', '/settings', 0),
+  ('GET', '/stats', 0),
+  ('GET', '/chores', 0),
+  ('GET', '/users', 1),
+  ('GET', '/names', 0),
+  ('GET', '/done_chores', 1),
+  ('GET', '/done_chores?reverse=true', 1),
+  ('GET', '/done_chores/1', 1),
+  ('GET', '/done_chores?reverse=true&begin={0}&end={0}'.format(now), 1),
+  ('GET', '/chore_name/1', 0),
+  ('GET', '/weekly_score/1/{0}/Friday/06:00'.format(now), 1),
+  ('GET', '/weekly_scores/{0}/Friday/06:00'.format(now), 1),
+  ('GET', '/winner/{0}/Friday/06:00'.format(now), 2),
+  ('GET', '/winners', 1),
+  ('GET', '/changes?since=0', 2),
+  ('GET', '/changes?since=5', 2),
+  ('PUT', '/chores/sweeping/5', 2),
+  ('PATCH', '/chores/1', 2),
+  ('PUT', '/done_chores/1/1/{0}'.format(now), 4),
+  ('DELETE', '/chores/1', 4),
+  ('POST', '/compact_history?keep_weeks=1', 6),
+]
+
+# Maximum HTTP calls and SQL statements to render the complete page
+page_http_budget = 8
+page_sql_budget = 5
+
+
+def call_route(made, method, url):
+  body = b'{"worth": 7}' if method == 'PATCH' else b''
+  before = made.statements.count
+  status, _ = wsgi_request(made.app, method, url, body)
+  assert status == 200, url
+  return made.statements.count - before
+
+
+@pytest.mark.parametrize('method,url,budget', api_budgets)
+def test_api_route_budget(make_household, method, url, budget):
+  counts = []
+  for size in sizes:
+    counts.append(call_route(make_household(*size), method, url))
+  assert max(counts) <= budget, counts
+  assert counts[-1] == counts[0], counts
+
+
+def render_page(made):
+  http_before = made.http.count
+  sql_before = made.statements.count
+  page = b''.join(chores_webpage_server.stream(
+      chores_webpage_server.complete_page(fixture_now, 'http://localhost/')))
+  page = page.decode('utf-8')
+  return page, made.http.count - http_before, made.statements.count - sql_before
+
+
+def test_complete_page_budget(make_household):
+  http_counts = []
+  sql_counts = []
+  for size in sizes:
+    _, http_count, sql_count = render_page(make_household(*size))
+    http_counts.append(http_count)
+    sql_counts.append(sql_count)
+  assert max(http_counts) <= page_http_budget, http_counts
+  assert max(sql_counts) <= page_sql_budget, sql_counts
+  assert http_counts[-1] == http_counts[0], http_counts
+  assert sql_counts[-1] == sql_counts[0], sql_counts
+
+
+def test_complete_page_lists_the_weeks_done_chores(make_household):
+  # Big enough to have history from earlier weeks
+  made = make_household(*sizes[2])
+  page, _, _ = render_page(made)
+  week = chores_lib.containing_date_range(fixture_now, 'Friday',
+      datetime.time(6, 0))
+  shown = 0
+  for done_chore in made.controller.done_chores():
+    popup = 'done_chore_{0}_popup'.format(done_chore['rowid'])
+    if week['begin'] <= done_chore['datetime'] < week['end']:
+      assert popup in page
+      shown += 1
+    else:
+      assert popup not in page
+  assert 0 < shown < len(made.controller.done_chores())
+  assert 'None' not in page
+
+
+def test_complete_page_reads_all_history_once(make_household, monkeypatch):
+  # users() scores everyone over all history, which no budget notices
+  # as it costs one statement however long the history gets
+  made = make_household(*sizes[1])
+  calls = []
+  users = chores_webpage_server.users
+  monkeypatch.setattr(chores_webpage_server, 'users',
+      lambda: calls.append(1) or users())
+  page, _, _ = render_page(made)
+  assert len(calls) == 1
+  for user in made.controller.users():
+    assert '?set_user_id_cookie={0}"'.format(user['rowid']) in page
+
+
+def test_page_head_is_sent_before_any_http_call(make_household):
+  made = make_household(*sizes[-1])
+  http_before = made.http.count
+  chunks = chores_webpage_server.stream(
+      chores_webpage_server.complete_page(fixture_now, 'http://localhost/'))
+  first = next(chunks)
+  assert first == chores_webpage_server.document_head().encode('utf-8')
+  assert made.http.count == http_before
+  rest = list(chunks)
+  assert len(rest) > 1
+  assert max(len(chunk) for chunk in rest) < 2 * 8192
@@ -0,0 +1,144 @@
+"""Scans are acknowledged at once and sent to the API in the background"""
+
+import datetime
+import sqlite3
+import threading
+import time
+
+import bottle
+
+
+from clients.web import chores_webpage_server, scan_queue
+from tests.conftest import wsgi_request
+
+web_app = bottle.default_app()
+
+
+def setup_scans(tmpdir, monkeypatch, send=None, warm=True):
+  scans = scan_queue.scan_queue(str(tmpdir.join('scans.sqlite')))
+  monkeypatch.setattr(chores_webpage_server, 'scans', scans)
+  catalog = chores_webpage_server.catalog_cache()
+  if warm:
+    assert catalog.refresh()
+  monkeypatch.setattr(chores_webpage_server, 'catalog', catalog)
+  return scans, scan_queue.scan_queue_worker(scans,
+      send or chores_webpage_server.send_scan)
+
+
+def scan(url, **kwargs):
+  return wsgi_request(web_app, 'GET', '/postget/?' + url, **kwargs)
+
+
+def test_scan_is_queued_then_sent(make_household, tmpdir, monkeypatch):
+  made = make_household(3, 3, 0)
+  scans, worker = setup_scans(tmpdir, monkeypatch)
+  status, body = scan('new_done_chore_chore_id=2&new_done_chore_user_id=1')
+  assert status == 200
+  assert b'chore1' in body and b'user0' in body
+  assert len(scans) == 1
+  assert made.controller.done_chores() == []
+
+  assert worker.flush()
+  assert len(scans) == 0
+  done = made.controller.done_chores()
+  assert [(x['user_id'], int(x['chore_id'])) for x in done] == [(1, 2)]
+
+
+def test_scan_uses_cached_catalog(make_household, tmpdir, monkeypatch):
+  made = make_household(3, 3, 0)
+  scans, _ = setup_scans(tmpdir, monkeypatch)
+  scan('new_done_chore_chore_id=1&new_done_chore_user_id=1')
+  calls = made.http.count
+  for user_id in (1, 2, 3):
+    scan('new_done_chore_chore_id=1',
+        headers={'Cookie': 'chores_id={0}'.format(user_id)})
+  assert made.http.count == calls
+  assert len(scans) == 4
+
+
+def test_unknown_chore_is_rejected(make_household, tmpdir, monkeypatch):
+  make_household(3, 3, 0)
+  scans, _ = setup_scans(tmpdir, monkeypatch)
+  status, _ = scan('new_done_chore_chore_id=99&new_done_chore_user_id=1')
+  assert status == 404
+  assert len(scans) == 0
+
+
+def test_scans_wait_while_api_is_down(make_household, tmpdir, monkeypatch):
+  make_household(3, 3, 0)
+  def api_down(user_id, chore_id, dt):
+    raise IOError('connection refused')
+  scans, worker = setup_scans(tmpdir, monkeypatch, send=api_down)
+  status, _ = scan('new_done_chore_chore_id=1&new_done_chore_user_id=1')
+  assert status == 200
+  assert not worker.flush()
+  assert len(scans) == 1
+
+
+def test_cold_catalog_with_api_down_still_queues(tmpdir, monkeypatch):
+  def api_down(*args, **kwargs):
+    raise IOError('connection refused')
+  monkeypatch.setattr(chores_webpage_server, 'names', api_down)
+  scans, _ = setup_scans(tmpdir, monkeypatch, warm=False)
+  status, body = scan('new_done_chore_chore_id=2&new_done_chore_user_id=1')
+  assert status == 200
+  assert b'Chore 2' in body
+  assert len(scans) == 1
+
+
+def test_scan_doesnt_wait_for_slow_api(tmpdir, monkeypatch):
+  answer = threading.Event()
+  def slow_names(timeout=None):
+    answer.wait(10)
+    return {'users': {1: 'user0'}, 'chores': {2: 'chore1'}}
+  monkeypatch.setattr(chores_webpage_server, 'names', slow_names)
+  scans, _ = setup_scans(tmpdir, monkeypatch, warm=False)
+  began = time.time()
+  for _ in range(2):
+    status, _ = scan('new_done_chore_chore_id=2&new_done_chore_user_id=1')
+    assert status == 200
+  assert time.time() - began < 1
+  assert len(scans) == 2
+  answer.set()
+
+
+def test_api_turns_away_unknown_chores(make_household, tmpdir, monkeypatch):
+  made = make_household(3, 3, 0)
+  scans, worker = setup_scans(tmpdir, monkeypatch, warm=False)
+  monkeypatch.setattr(chores_webpage_server.catalog, 'refresh_in_background',
+      lambda: None)
+  status, _ = scan('new_done_chore_chore_id=99&new_done_chore_user_id=1')
+  assert status == 200
+  assert worker.flush()
+  assert len(scans) == 0
+  assert made.controller.done_chores() == []
+
+
+def test_households_sharing_a_queue_file_get_their_own_scans(tmpdir):
+  path = str(tmpdir.join('scans.sqlite'))
+  smiths = scan_queue.scan_queue(path, api_url='http://localhost:8190/households/smiths')
+  joneses = scan_queue.scan_queue(path, api_url='http://localhost:8190/households/joneses')
+  dt = datetime.datetime(2015, 9, 7, 22, 0)
+  smiths.put(1, 2, dt)
+  joneses.put(3, 4, dt)
+  sent = []
+  scan_queue.scan_queue_worker(smiths,
+      lambda *scan: sent.append(scan) or 200).flush()
+  assert sent == [(1, 2, dt)]
+  assert (len(smiths), len(joneses)) == (0, 1)
+  assert [scan[1:] for scan in joneses.pending()] == [(3, 4, dt)]
+
+
+def test_scans_queued_before_api_urls_were_recorded(tmpdir):
+  path = str(tmpdir.join('scans.sqlite'))
+  connection = sqlite3.connect(path)
+  connection.execute("""CREATE TABLE pending_scans (
+      rowid INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+      chore_id INTEGER NOT NULL, datetime TEXT NOT NULL);""")
+  connection.execute("INSERT INTO pending_scans (user_id, chore_id, datetime) "
+      "VALUES (1, 2, '2015-09-07 22:00:00.000000');")
+  connection.commit()
+  connection.close()
+  scans = scan_queue.scan_queue(path, api_url='http://localhost:8190')
+  assert len(scans) == 1
+  assert len(scan_queue.scan_queue(path, api_url='http://elsewhere:8190')) == 0
@@ -0,0 +1,65 @@
+"""Heavy dependencies stay out of startup"""
+
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from chores_lib import chores_lib
+from tests.conftest import build_database
+
+
+def modules_loaded_by_importing(module):
+  output = subprocess.check_output([sys.executable, '-c',
+      'import sys, {0}; print(" ".join(sys.modules))'.format(module)])
+  return set(output.decode('utf-8').split())
+
+
+@pytest.mark.parametrize('module,deferred', [
+  ('chores_api.chores_api', ['sqlalchemy', 'requests', 'yaml']),
+  ('clients.web.chores_webpage_server', ['qrcode', 'furl', 'requests', 'yaml', 'dateutil']),
+])
+def test_heavy_modules_are_deferred(module, deferred):
+  loaded = modules_loaded_by_importing(module)
+  for name in deferred:
+    assert name not in loaded
+
+
+# Runs chores_api.main() up to where it would serve, printing the
+# modules loaded by then instead
+serve_main = """
+import sys
+from chores_api import chores_api
+started = []
+chores_api.rollover_scheduler.start = lambda self: started.append(self)
+def run(**kwargs):
+  print(" ".join(sys.modules) if started else "scheduler not started")
+chores_api.bottle.run = run
+sys.argv = ['chores_api', sys.argv[1]]
+chores_api.main()
+"""
+
+def test_main_opens_no_database_before_serving(tmpdir):
+  path = str(tmpdir.join('chores.sql'))
+  build_database(path, 2, 2, 2)
+  config = tmpdir.join('chores_apirc.yaml')
+  config.write('path_to_database: {0}\nhost_name: localhost\nport: 8190\n'
+      "debug_mode: ''\n".format(path))
+  output = subprocess.check_output([sys.executable, '-c', serve_main,
+      str(config)])
+  loaded = set(output.decode('utf-8').split())
+  assert 'bottle' in loaded
+  assert 'sqlalchemy' not in loaded
+  # Not even migrated: that's the scheduler's first run, in its thread
+  connection = sqlite3.connect(path)
+  assert connection.execute("SELECT count(*) FROM sqlite_master "
+      "WHERE name = 'changes'").fetchone() == (0,)
+  connection.close()
+
+
+def test_lazy_module_imports_on_first_use():
+  lazy_json = chores_lib.lazy_module('json')
+  assert lazy_json._module is None
+  assert lazy_json.loads('[1]') == [1]
+  assert lazy_json._module is not None
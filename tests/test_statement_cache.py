@@ -0,0 +1,59 @@
+"""Controller statements are compiled once and reused"""
+
+import datetime
+import json
+
+import sqlalchemy
+
+from tests.conftest import fixture_now, rollover_day, rollover_time, wsgi_request
+
+
+def exercise(controller):
+  controller.weekly_scores(fixture_now, rollover_day, rollover_time)
+  controller.weekly_score(1, fixture_now, rollover_day, rollover_time)
+  controller.users()
+  controller.winner(fixture_now, rollover_day, rollover_time)
+  controller.weekly_winners(limit=3)
+  controller.done_chores(user_id=1, reverse=True)
+  controller.new_done_chore(1, 1, fixture_now)
+  controller.change_chore(1, worth=3)
+
+
+def test_repeated_queries_hit_the_cache(make_controller):
+  controller = make_controller(3, 4, 20)
+  exercise(controller)
+  misses = controller.statement_cache.misses
+  exercise(controller)
+  stats = controller.statement_cache.stats()
+  assert stats['misses'] == misses
+  assert stats['hits'] > 0
+  assert 0 < stats['hit_rate'] < 1
+
+
+def test_names_are_bound_not_spliced(make_controller):
+  controller = make_controller(3, 4, 2)
+  name = "x'); DROP TABLE chores; --"
+  controller.new_chore(name, 2)
+  controller.reload_catalog()
+  assert controller.chore_name(controller.rowid(name, 'chore')) == name
+
+
+def test_stats_route(make_household):
+  made = make_household(3, 4, 2)
+  wsgi_request(made.app, 'GET', '/users')
+  wsgi_request(made.app, 'GET', '/users')
+  status, body = wsgi_request(made.app, 'GET', '/stats')
+  assert status == 200
+  assert json.loads(body)['stats']['statement_cache']['hits'] > 0
+
+
+def test_connection_survives_commits(make_controller):
+  controller = make_controller(3, 4, 2)
+  connects = []
+  sqlalchemy.event.listen(controller.session.bind, 'connect',
+      lambda connection, record: connects.append(connection))
+  for minutes in range(3):
+    controller.new_done_chore(1, 1,
+        fixture_now + datetime.timedelta(minutes=minutes))
+    controller.users()
+  assert connects == []
@@ -0,0 +1,138 @@
+"""Hashed, precompressed static assets and compressed pages"""
+
+import gzip
+import hashlib
+import io
+import os
+
+import bottle
+
+from chores_lib import chores_lib
+from clients.web import chores_webpage_server, static_assets
+from tests.conftest import fake_response, fixture_now, wsgi_response
+
+font_awesome_css = b"""@font-face{font-family:'FontAwesome';
+src:url('../fonts/fontawesome-webfont.eot?v=4.3.0');
+src:url('../fonts/fontawesome-webfont.woff?v=4.3.0') format('woff'),
+url(data:font/woff;base64,AAAA) format('woff')}
+.fa{display:inline-block}""" * 20
+
+
+def write(root, path, content):
+  full_path = os.path.join(root, *path.split('/'))
+  if not os.path.exists(os.path.dirname(full_path)):
+    os.makedirs(os.path.dirname(full_path))
+  with open(full_path, 'wb') as f:
+    f.write(content)
+
+
+def gunzip(body):
+  return gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+
+
+def test_css_refers_to_hashed_fonts(tmpdir):
+  root = str(tmpdir)
+  write(root, 'vendor/font-awesome-4.3.0/css/font-awesome.min.css', font_awesome_css)
+  write(root, 'vendor/font-awesome-4.3.0/fonts/fontawesome-webfont.eot', b'eot')
+  write(root, 'vendor/font-awesome-4.3.0/fonts/fontawesome-webfont.woff', b'woff')
+  bundle = static_assets.asset_bundle({'': root})
+  css = bundle.get('vendor/font-awesome-4.3.0/css/font-awesome.min.css')
+  woff = bundle.get('vendor/font-awesome-4.3.0/fonts/fontawesome-webfont.woff')
+  rewritten = css.encodings['identity']
+  assert "url('{0}?v=4.3.0')".format(static_assets.hashed_url(woff)) in rewritten
+  assert 'url(data:font/woff;base64,AAAA)' in rewritten
+  assert 'gzip' in css.encodings
+  assert gunzip(css.encodings['gzip']) == rewritten
+  # Already compressed
+  assert list(woff.encodings) == ['identity']
+  assert bundle.url('vendor/font-awesome-4.3.0/css/font-awesome.min.css') == \
+      static_assets.hashed_url(css)
+  # Not fetched, so from the CDN
+  assert bundle.url('vendor/jquery-1.8.2/jquery-1.8.2.min.js') == \
+      static_assets.vendored['vendor/jquery-1.8.2/jquery-1.8.2.min.js']
+
+
+def test_compressed_variants_are_cached(tmpdir, monkeypatch):
+  root = str(tmpdir.join('static'))
+  cache_dir = str(tmpdir.join('cache'))
+  write(root, 'css/a.css', b'a { color: red; }\n' * 100)
+  write(root, 'css/b.css', b'b { color: blue; }\n' * 100)
+  first = static_assets.asset_bundle({'': root}, cache_dir)
+  first.build()
+  assert set(os.listdir(cache_dir)) >= set(
+      hashlib.sha1(found.encodings['identity']).hexdigest() + '.gz'
+      for found in first.assets.values())
+
+  def no_compressing(content):
+    raise AssertionError('compressed again')
+  monkeypatch.setattr(static_assets, 'compressors', dict(
+      (encoding, (extension, compress and no_compressing))
+      for encoding, (extension, compress) in static_assets.compressors.items()))
+  second = static_assets.asset_bundle({'': root}, cache_dir)
+  assert second.get('css/a.css') == first.get('css/a.css')
+
+  os.remove(os.path.join(root, 'css', 'b.css'))
+  second.build()
+  removed = second.prune_cache()
+  assert removed and all(filename.startswith(
+      hashlib.sha1(first.get('css/b.css').encodings['identity']).hexdigest())
+      for filename in removed)
+  assert second.prune_cache() == []
+
+
+def test_choose_encoding():
+  found = static_assets.make_asset('a.css', b'a { color: red; }\n' * 100)
+  assert static_assets.choose_encoding(found, 'gzip, deflate')[0] == 'gzip'
+  assert static_assets.choose_encoding(found, 'gzip;q=0')[0] == 'identity'
+  assert static_assets.choose_encoding(found, None)[0] == 'identity'
+
+
+def test_assets_are_served_cacheable_and_compressed():
+  app = bottle.default_app()
+  found = chores_webpage_server.assets.get('css/animate.min.css')
+  url = static_assets.hashed_url(found)
+  status, headers, body = wsgi_response(app, 'GET', url,
+      headers={'Accept-Encoding': 'gzip'})
+  assert status == 200
+  assert headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+  assert headers['Content-Encoding'] == 'gzip'
+  assert gunzip(body) == found.encodings['identity']
+  assert url in chores_webpage_server.document_head()
+
+  status, _, _ = wsgi_response(app, 'GET', url,
+      headers={'If-None-Match': '"{0}"'.format(found.digest)})
+  assert status == 304
+  status, _, _ = wsgi_response(app, 'GET', url.replace(found.digest, '0' * 12))
+  assert status == 404
+  status, headers, body = wsgi_response(app, 'GET', '/animate.min.css')
+  assert status == 200
+  assert body == found.encodings['identity']
+
+
+def test_page_is_gzipped(make_household):
+  made = make_household(3, 4, 5)
+  app = bottle.default_app()
+  status, headers, body = wsgi_response(app, 'GET',
+      '/?datetime=2015-09-07+22:00:00', headers={'Accept-Encoding': 'gzip'})
+  assert status == 200
+  assert headers['Content-Encoding'] == 'gzip'
+  page = gunzip(body).decode('utf-8')
+  assert page.startswith(chores_webpage_server.document_head())
+  assert page.rstrip().endswith('</html>')
+
+
+def test_fetch_vendored(tmpdir, monkeypatch):
+  fetched_urls = []
+  class cdn(object):
+    def get(self, url):
+      fetched_urls.append(url)
+      if url.endswith('.css'):
+        return fake_response(200, font_awesome_css)
+      return fake_response(200, b'x')
+  monkeypatch.setattr(chores_lib, 'requests', cdn())
+  fetched = static_assets.fetch_vendored(str(tmpdir))
+  assert 'vendor/font-awesome-4.3.0/fonts/fontawesome-webfont.woff' in fetched
+  assert 'https://maxcdn.bootstrapcdn.com/font-awesome/4.3.0/fonts/fontawesome-webfont.eot' \
+      in fetched_urls
+  # Nothing left to fetch
+  assert static_assets.fetch_vendored(str(tmpdir)) == []
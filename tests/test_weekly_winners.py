@@ -0,0 +1,68 @@
+"""Recording weekly standings and serving winners from them"""
+
+import datetime
+
+from chores_api import chores_api
+from tests.conftest import build_database, fixture_now, rollover_day, rollover_time
+
+weeks = [fixture_now - datetime.timedelta(weeks=i) for i in range(6)]
+
+
+def winners(controller):
+  return [controller.winner(week, rollover_day, rollover_time) for week in weeks]
+
+
+def test_recorded_winners_match_computed_ones(make_controller):
+  controller = make_controller(3, 4, 100)
+  computed = winners(controller)
+  recorded = controller.record_weekly_standings(fixture_now, rollover_day,
+      rollover_time)
+  assert len(recorded) == 4
+  assert winners(controller) == computed
+  history = controller.weekly_winners()
+  assert [x['week_begin'] for x in history] == list(reversed(recorded))
+  assert controller.weekly_winners(limit=2) == history[:2]
+
+
+def test_missed_weeks_are_backfilled(make_controller):
+  controller = make_controller(3, 4, 100)
+  first = controller.record_weekly_standings(
+      fixture_now - datetime.timedelta(weeks=2), rollover_day, rollover_time)
+  later = controller.record_weekly_standings(fixture_now, rollover_day,
+      rollover_time)
+  assert len(later) == 2
+  assert not set(first) & set(later)
+  assert controller.record_weekly_standings(fixture_now, rollover_day,
+      rollover_time) == []
+
+
+def test_new_done_chore_in_a_recorded_week_is_counted(make_controller):
+  controller = make_controller(3, 4, 100)
+  controller.record_weekly_standings(fixture_now, rollover_day, rollover_time)
+  last_week = fixture_now - datetime.timedelta(weeks=1)
+  for i in range(20):
+    # Distinct keys, or they'd count as one
+    assert controller.new_done_chore(3, 4, last_week,
+        idempotency_key='late-{0}'.format(i))
+  assert controller.winner(last_week, rollover_day, rollover_time)['name'] == 'user2'
+  assert controller.record_weekly_standings(fixture_now, rollover_day,
+      rollover_time) == [datetime.datetime(2015, 8, 28, 6, 0)]
+  assert controller.weekly_winners()[0]['name'] == 'user2'
+
+
+def test_scheduler_records_every_household(tmpdir):
+  households = {}
+  for name in ('smiths', 'joneses'):
+    path = str(tmpdir.join(name + '.sql'))
+    build_database(path, 2, 2, 50)
+    households[name] = {'path_to_database': path}
+  scheduler = chores_api.rollover_scheduler(households)
+  scheduler.run_once(fixture_now)
+  for name in households:
+    assert scheduler.pool.controller(name).weekly_winners()
+
+
+def test_next_rollover():
+  settings = {'rollover_day': 'Friday', 'rollover_time': '06:00'}
+  assert chores_api.next_rollover(settings, fixture_now) == \
+      datetime.datetime(2015, 9, 11, 6, 0)